@@ -5,19 +5,118 @@ from __future__ import print_function
 import argparse
 import logging
 import logging.handlers
+import queue
+import atexit
+import contextlib
+import threading
+import concurrent.futures
 import time
+import random
 import sys
-from datetime import datetime, timedelta
-import pytz
-import boto3
-from dateutil.relativedelta import relativedelta
-from grandfatherson import dates_to_keep, SATURDAY
-from redo import retriable, retry
+import os
+import json
+import itertools
+import collections
+import functools
+import sqlite3
+import csv
+import hashlib
+import socket
+import uuid
+import weakref
+import zlib
+from calendar import SATURDAY
+from datetime import date, datetime, timedelta, timezone
+from botocore.exceptions import ClientError
+
+# boto3, dateutil and redo are imported where first used, so that importing this module
+# (a Lambda cold start in particular) doesn't pay for them up front
+
+
+def retriable(*retryArgs, **retryKwargs):
+    # redo.retriable, importing redo on the first call instead of at import time
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            from redo import retry
+            return retry(func, args=args, kwargs=kwargs, *retryArgs, **retryKwargs)
+        return wrapper
+    return decorate
+
+
+class SnapshotRecord(object):
+    # Compact stand-in for a boto3 Snapshot resource, holding only what classification
+    # and deletion need.  Exposes the same attribute names the resource does.
+    __slots__ = ('snapshot_id', 'start_time', 'volume_id', 'volume_size', 'tags')
+
+    def __init__(self, snapshot_id, start_time, volume_id, volume_size, tags=None):
+        self.snapshot_id = snapshot_id
+        self.start_time = start_time
+        self.volume_id = volume_id
+        self.volume_size = volume_size
+        self.tags = tags
+
+    @property
+    def id(self):
+        return self.snapshot_id
+
+    @property
+    def description(self):
+        return ''
 
 
 class SnapClean(object):
     DATE_FORMAT = "%a %b %d %Y"
 
+    # Keys of the per-run results dict
+    TOTAL_SNAPSHOTS_FOUND = 'totalSnapshotsFound'
+    EXPIRED_SNAPSHOTS_FOUND = 'expiredSnapshotsFound'
+    SNAPSHOTS_DELETED = 'deletedSnapshots'
+    EXCEPTIONS_ENCOUNTERED = 'exceptionsEncountered'
+    TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS = 'totalSnapshotsAssociatedWithAMIs'
+    TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS = 'totalInscopeSnapshotsAssociatedWithAMIs'
+    VERDICTS_REUSED = 'verdictsReused'
+    VERDICTS_RECOMPUTED = 'verdictsRecomputed'
+
+    # A delete that finds the snapshot already gone has still done its job
+    SNAPSHOT_NOT_FOUND = 'InvalidSnapshot.NotFound'
+
+    # The VolumeId EC2 reports for snapshots that were copied rather than taken from a volume
+    UNKNOWN_VOLUME = 'vol-ffffffff'
+
+    # Deletion engine defaults
+    DEFAULT_CONCURRENCY = 4
+    DEFAULT_RATE = 5.0
+    DEFAULT_BURST = 10
+    DEFAULT_QUEUE_SIZE = 100
+
+    # Largest page DescribeSnapshots returns
+    SNAPSHOT_PAGE_SIZE = 1000
+
+    # How long a persisted AMI index is used before it is refreshed
+    DEFAULT_AMI_CACHE_TTL = 3600
+
+    # Delete failures are sent as one SNS digest per run, or sooner after this many events or seconds
+    DEFAULT_DIGEST_EVENTS = 500
+    DEFAULT_DIGEST_SECONDS = 300
+
+    # Rotation of the per region and tag log file
+    DEFAULT_LOG_MAX_BYTES = 512 * 1024
+    DEFAULT_LOG_BACKUPS = 10
+
+    # Under Lambda, stop queueing deletes once fewer than this many seconds remain
+    DEFAULT_LAMBDA_RESERVE_SECONDS = 30
+
+    # A job's lease expires this many seconds after its holder last renewed it
+    DEFAULT_LOCK_TTL = 600
+
+    # Snapshot ids per DescribeImages call when --apply-plan re-checks AMI usage
+    AMI_RECHECK_BATCH = 200
+    LISTING_PAGE_ATTEMPTS = 8
+    # Whether a snapshot can be listed by more than one partition of a partitioned listing
+    PARTITIONS_OVERLAP = False
+    LISTING_CHECKPOINT_TTL = 6 * 3600
+
     def __init__(self,
                  region,
                  policyDay,
@@ -27,7 +126,37 @@ class SnapClean(object):
                  tagValue,
                  account,
                  logLevel,
-                 dryRunFlag):
+                 dryRunFlag,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 rate=DEFAULT_RATE,
+                 burst=DEFAULT_BURST,
+                 maxRate=None,
+                 streamFlag=False,
+                 queueSize=DEFAULT_QUEUE_SIZE,
+                 fastListing=False,
+                 stateDb=None,
+                 resumeFlag=False,
+                 amiCacheDir=None,
+                 amiCacheTtl=DEFAULT_AMI_CACHE_TTL,
+                 digestEvents=DEFAULT_DIGEST_EVENTS,
+                 digestSeconds=DEFAULT_DIGEST_SECONDS,
+                 logQueue=False,
+                 logMaxBytes=DEFAULT_LOG_MAX_BYTES,
+                 logBackups=DEFAULT_LOG_BACKUPS,
+                 decisionsFlag=False,
+                 metricsFlag=False,
+                 prometheusDir=None,
+                 shard=None,
+                 shardBy='volume',
+                 lockSpec=None,
+                 lockTtl=DEFAULT_LOCK_TTL,
+                 retentionGroup=None,
+                 planFormat=None,
+                 applyPlan=False,
+                 assumeRole=None,
+                 externalId=None,
+                 listingCheckpoint=False,
+                 listConcurrency=0):
 
         self.region = region
         self.policyDay = policyDay
@@ -38,12 +167,69 @@ class SnapClean(object):
         self.account = account
         self.logLevel = logLevel
         self.dryRunFlag = dryRunFlag
-        self.currDateTime = datetime.now(pytz.utc)
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.maxRate = maxRate
+        self.streamFlag = streamFlag
+        self.queueSize = queueSize
+        self.fastListing = fastListing
+        self.stateDb = stateDb
+        self.resumeFlag = resumeFlag
+        self.amiCacheDir = amiCacheDir
+        self.amiCacheTtl = amiCacheTtl
+        self.digestEvents = digestEvents
+        self.digestSeconds = digestSeconds
+        self.logQueue = logQueue
+        self.logMaxBytes = logMaxBytes
+        self.logBackups = logBackups
+        self.decisionsFlag = decisionsFlag
+        self.metricsFlag = metricsFlag
+        self.prometheusDir = prometheusDir
+        self.shard = shard
+        self.shardBy = shardBy
+        self.lockSpec = lockSpec
+        self.lockTtl = lockTtl
+        self.lease = None
+        self.retentionGroup = retentionGroup
+        self.planFormat = planFormat
+        self.applyPlan = applyPlan
+        self.planWriter = None
+        self.assumeRole = assumeRole
+        self.externalId = externalId
+        self.listingCheckpoint = listingCheckpoint
+        self.listConcurrency = listConcurrency
+        self.currDateTime = datetime.now(timezone.utc)
+        # A fixed date to classify against instead of today, so a run can be reproduced
+        self.pinnedDate = None
         self.initLogging(self.logLevel)
 
+        # Phase timings, API call latencies and queue depths for the run report
+        self.metrics = RunMetrics()
+        self.exportMetrics = True
+
+        # Optional time budget: a callable returning the seconds left, checked before each
+        # delete is queued.  When it runs out the remaining deletes stay in the journal.
+        self.remainingTime = None
+        self.reserveSeconds = SnapClean.DEFAULT_LAMBDA_RESERVE_SECONDS
+        self.interrupted = False
+
+        # Sessions and clients come from the process wide pool, so every instance in the
+        # same account and region reuses one client and its warm connections.  With an
+        # assume-role name they run on that role in the account instead of on the ambient
+        # credentials.
+        self.poolAccount = self.account if self.assumeRole else None
+        self.session = ClientPool.session(self.poolAccount, self.assumeRole, self.externalId)
+        self.ec2Client = None
+        self.ec2Resource = None
+
+        # Shared by every EC2 API call this instance makes: listing, image scan and deletes
+        self.throttle = AdaptiveRateLimiter(self.rate, self.burst, maxRate=self.maxRate, logger=self.logger)
+
     def initLogging(self, loglevel):
-        # Setup the Logger
-        self.logger = logging.getLogger('SnapClean')  # The Module Name
+        # Setup the Logger, one per region and tag so concurrent runs keep separate log streams
+        self.logger = logging.getLogger('SnapClean.' + self.fileStem())
+        self.logger.propagate = False
 
         # Set logging level
         loggingLevelSelected = logging.INFO
@@ -61,7 +247,7 @@ class SnapClean(object):
         elif (loglevel == 'notset'):
             loggingLevelSelected = logging.NOTSET
 
-        filenameVal = self.region + '_' + self.tagValue + '_SnapClean.log'
+        filenameVal = self.fileStem() + '_SnapClean.log'
         log_formatter = logging.Formatter(
             '[%(asctime)s][%(levelname)s]%(message)s'
             )
@@ -70,30 +256,50 @@ class SnapClean(object):
         handler = logging.handlers.RotatingFileHandler(
             filename=filenameVal,
             mode='a',
-            maxBytes=512 * 1024,
-            backupCount=10)
+            maxBytes=self.logMaxBytes,
+            backupCount=self.logBackups)
         handler.setFormatter(log_formatter)
-
-        self.logger.addHandler(handler)
+        LogQueue.attach(self.logger, handler, self.logQueue)
         self.logger.setLevel(loggingLevelSelected)
 
-    def generateInclusionDatesList(self):
+        # Optional JSON lines record of every per-snapshot decision, one object per line
+        self.decisions = None
+        if self.decisionsFlag:
+            self.decisions = logging.getLogger('SnapCleanDecisions.' + self.fileStem())
+            self.decisions.propagate = False
+            decisionsHandler = logging.FileHandler(self.fileStem() + '_SnapClean.decisions.jsonl', mode='a', delay=True)
+            decisionsHandler.setFormatter(JsonLinesFormatter())
+            LogQueue.attach(self.decisions, decisionsHandler, self.logQueue)
+            self.decisions.setLevel(logging.INFO)
+
+    def decide(self, snapshot, decision, reason):
+        if self.planWriter is not None and decision == 'expire':
+            self.planWriter.write(snapshot, reason)
+        # The dict is only serialized by the handler, off the deletion threads in --log-queue mode
+        if self.decisions is not None:
+            self.decisions.info({
+                'time': time.time(),
+                'snapshot': snapshot.snapshot_id,
+                'volume': snapshot.volume_id,
+                'start': snapshot.start_time,
+                'decision': decision,
+                'reason': reason,
+                'tag': self.tagValue,
+                'region': self.region
+            })
+
+    def currentDate(self):
+        # Today in UTC, or the pinned date
+        return self.pinnedDate or datetime.now(timezone.utc).date()
 
-        end_range_date = datetime.now(pytz.utc).date()
-        start_range_date = datetime.now(pytz.utc)
+    def generateRetentionIndex(self):
+
+        end_range_date = self.currentDate()
 
         # Calculate the date range where snapshots will
         # be evaluated against by the grandfatherson algorithm.
-        if self.policyMonth > 0:
-            start_range_date = end_range_date - relativedelta(
-                months=self.policyMonth)
-        elif self.policyWeek > 0:
-            start_range_date = end_range_date - relativedelta(
-                weeks=self.policyWeek)
-        elif self.policyDay > 0:
-            start_range_date = end_range_date - relativedelta(
-                days=self.policyDay)
-        else:
+        start_range_date = RetentionIndex.rangeStart(self.policyDay, self.policyWeek, self.policyMonth, end_range_date)
+        if start_range_date is None:
             self.logger.error('error: no policy values specified, exiting')
             sys.exit(-1)
 
@@ -102,31 +308,292 @@ class SnapClean(object):
             'weekly': self.policyWeek,
             'monthly': self.policyMonth
         })
-        self.logger.info('Start of Range date in UTC: ' + start_range_date.strftime(SnapClean.DATE_FORMAT))
-        self.logger.info('End of Range date in UTC: ' + end_range_date.strftime(SnapClean.DATE_FORMAT))
-
-        inclusionDatesList = [start_range_date + timedelta(days=i) for i in range((end_range_date - start_range_date).days + 1)]
-
-        # This is where the Grandfatherson algorithm is put in play
-        return sorted(
-            dates_to_keep(
-                inclusionDatesList,
-                days=self.policyDay,
-                weeks=self.policyWeek,
-                months=self.policyMonth,
-                firstweekday=SATURDAY,
-                now=end_range_date
-            )
-        )
+        self.logger.info('Start of Range date in UTC: %s', start_range_date.strftime(SnapClean.DATE_FORMAT))
+        self.logger.info('End of Range date in UTC: %s', end_range_date.strftime(SnapClean.DATE_FORMAT))
+
+        # Built once per (policy, today) and shared by every job using the same policy
+        return RetentionIndex.forPolicy(self.policyDay, self.policyWeek, self.policyMonth, end_range_date)
+
+    def generateInclusionDatesList(self):
+        return self.generateRetentionIndex().retainedDates()
+
+    @staticmethod
+    def parsePolicy(policy):
+        # Day:Week:Month notation, eg. 7:5:12
+        policy_split = policy.split(":")
+        return int(policy_split[0]), int(policy_split[1]), int(policy_split[2])
 
     def snsInit(self):
         sns_topic_name = "SnapClean"
-        self.sns = SnsNotifier(sns_topic_name)
+        self.sns = SnsNotifier(sns_topic_name,
+                               '%s %s' % (self.region, self.tagValue),
+                               self.digestEvents,
+                               self.digestSeconds,
+                               logger=self.logger)
+        self.sns.metrics = self.metrics
+
+    def pooledClient(self, service, resource=False):
+        # The pool is sized for the deletion threads, the listing threads (one unless the
+        # listing is partitioned) and the AMI scan
+        return ClientPool.client(service, self.region, self.poolAccount, self.assumeRole, self.externalId,
+                                 connections=self.concurrency + max(self.listConcurrency, 1) + 1,
+                                 metrics=self.metrics, resource=resource)
+
+    def getEc2Client(self):
+        # Low level client, shared by the deletion threads
+        if self.ec2Client is None:
+            self.ec2Client = self.pooledClient('ec2')
+        return self.ec2Client
+
+    def getEc2Resource(self):
+        if self.ec2Resource is None:
+            self.ec2Resource = self.pooledClient('ec2', resource=True)
+        return self.ec2Resource
+
+    def throttledPages(self, operation, **params):
+        # Pages of an EC2 DescribeX call, following NextToken by hand so each page is
+        # paced, and retried on its own, under the shared rate limiter
+        pageNumber = 1
+        while True:
+            page = self.fetchPage(operation, params, pageNumber)
+            yield page
+            if not page.get('NextToken'):
+                return
+            params = dict(params, NextToken=page['NextToken'])
+            pageNumber += 1
+
+    def tagFilter(self):
+        return {
+            'Name': 'tag:' + self.tagKey,
+            'Values': [self.tagValue]
+        }
+
+    def recordTagKeys(self):
+        # Tag keys worth keeping on a SnapshotRecord: only a --retention-group tag for a single tag job
+        return frozenset(self.groupTagKeys())
+
+    def groupTagKeys(self):
+        if self.retentionGroup and self.retentionGroup.startswith('tag:'):
+            return [self.retentionGroup[len('tag:'):]]
+        return []
+
+    def retentionGroupKey(self, snapshot):
+        # Snapshots without a real source volume (copies carry vol-ffffffff) or without the
+        # group tag are each their own group, rather than being retained as one
+        if self.retentionGroup == 'volume':
+            key = snapshot.volume_id
+            return key if key and key != SnapClean.UNKNOWN_VOLUME else snapshot.snapshot_id
+        tagKey = self.groupTagKeys()[0]
+        for tag in (snapshot.tags or []):
+            if tag['Key'] == tagKey:
+                return 'tag:' + tag['Value']
+        return snapshot.snapshot_id
+
+    @staticmethod
+    def retriablePageError(e):
+        from botocore.exceptions import ConnectionError, HTTPClientError
+        if isinstance(e, (ConnectionError, HTTPClientError)):
+            return True
+        return isinstance(e, ClientError) and (
+            AdaptiveRateLimiter.errorCode(e) in AdaptiveRateLimiter.THROTTLE_ERROR_CODES or
+            e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+
+    def fetchSnapshotPage(self, targetFilter, nextToken, pageNumber):
+        params = {'Filters': targetFilter, 'MaxResults': SnapClean.SNAPSHOT_PAGE_SIZE}
+        if nextToken:
+            params['NextToken'] = nextToken
+        return self.fetchPage('describe_snapshots', params, pageNumber)
+
+    def fetchPage(self, operation, params, pageNumber):
+        # One page of an EC2 DescribeX call under the rate limit.  Throttling, server errors
+        # and dropped connections retry this page alone, with jittered exponential backoff.
+        # The EC2 client itself makes a single attempt, see ClientPool.config.
+        for attempt in range(1, SnapClean.LISTING_PAGE_ATTEMPTS + 1):
+            self.throttle.acquire()
+            try:
+                page = getattr(self.getEc2Client(), operation)(**params)
+            except Exception as e:
+                if isinstance(e, ClientError):
+                    self.throttle.onError(e)
+                if attempt == SnapClean.LISTING_PAGE_ATTEMPTS or not SnapClean.retriablePageError(e):
+                    raise
+                self.logger.warning('Exception fetching %s page %s (attempt %s), retrying the page, %s', operation, pageNumber, attempt, str(e))
+                self.metrics.event('listingPageRetries')
+                self.throttle.backoff(attempt)
+                continue
+            self.throttle.onSuccess()
+            return page
+
+    def listingFailed(self, pageNumber, e):
+        # A page that failed for good (its retries are spent, or the error isn't retriable)
+        # ends the listing, and so the run
+        msg = "Exception filtering snapshots at page %s %s" % (pageNumber, str(e))
+        self.logger.error(msg)
+        snsSubject = 'SnapClean.py : Exception filtering snapshots'
+        snsMessage = '%s' % (str(e))
+        self.sns.sendSns(snsSubject, snsMessage)
+
+    def listSnapshotPages(self, targetFilter, partition=None):
+        # Pages of raw snapshot dicts, following NextToken by hand so a failure costs one
+        # page rather than the listing.  With a listing checkpoint each page is persisted
+        # with the token after it, and a run interrupted mid-listing replays the pages it
+        # already has, then carries on from the token.
+        checkpoint = None
+        nextToken = None
+        pageNumber = 1
+        replay = []
+        if self.listingCheckpoint:
+            tagKeys = self.recordTagKeys()
+            listingHash = hashlib.sha256(json.dumps([self.account, self.region, targetFilter,
+                                                     sorted(tagKeys)]).encode()).hexdigest()[:16]
+            checkpoint = ListingCheckpoint(self.listingCheckpointPath(partition), listingHash, tagKeys)
+            nextToken, replay = checkpoint.resume(SnapClean.LISTING_CHECKPOINT_TTL)
+            pageNumber = len(replay) + 1
+
+        if nextToken:
+            self.logger.info('Resuming the listing at page %s from checkpoint %s', pageNumber, checkpoint.path)
+            try:
+                # Fetch the next live page before replaying, so an expired token can still fall back
+                page = self.fetchSnapshotPage(targetFilter, nextToken, pageNumber)
+            except ClientError as e:
+                self.logger.warning('Listing checkpoint could not be resumed, listing from the start, %s', str(e))
+                nextToken, replay, pageNumber = None, [], 1
+            except Exception as e:
+                self.listingFailed(pageNumber, e)
+                raise
+            else:
+                for snapshots in replay:
+                    yield {'Snapshots': snapshots}
+                checkpoint.page(page['Snapshots'], page.get('NextToken'))
+                yield page
+                nextToken = page.get('NextToken')
+                pageNumber += 1
+                if not nextToken:
+                    checkpoint.complete()
+                    return
+        if checkpoint is not None and not nextToken:
+            checkpoint.start()
+
+        while True:
+            try:
+                page = self.fetchSnapshotPage(targetFilter, nextToken, pageNumber)
+            except Exception as e:
+                self.listingFailed(pageNumber, e)
+                raise
+            nextToken = page.get('NextToken')
+            if checkpoint is not None:
+                checkpoint.page(page['Snapshots'], nextToken)
+            yield page
+            if not nextToken:
+                break
+            pageNumber += 1
+        if checkpoint is not None:
+            checkpoint.complete()
+
+    def listingCheckpointPath(self, partition=None):
+        # One checkpoint per partition of a partitioned listing
+        suffix = '' if partition is None else '.%s' % partition
+        return self.fileStem() + '_SnapClean.listing' + suffix
+
+    def listingPartitions(self, baseFilter):
+        # (name, filters) slices that together list everything the job's filter does, once.
+        # By volume id patterns rather than batches of describe_volumes ids, which would
+        # miss the snapshots of deleted volumes and copies (vol-ffffffff).  Current ids are
+        # all vol-0 and 16 random hex digits, so are split on the digit after the 0; legacy
+        # 8 digit ids starting 0 fall in those slices too.  The other legacy ids make one
+        # slice, and the copies another, as an account can hold a lot of them.
+        slices = [('vol-0%x*' % digit, ['vol-0%x*' % digit]) for digit in range(16)]
+        legacy = ['vol-%s%x%s' % ('f' * run, digit, '?' * (7 - run))
+                  for run in range(8) for digit in range(1 if run == 0 else 0, 15)]
+        slices.append(('vol-????????', legacy))
+        slices.append((SnapClean.UNKNOWN_VOLUME, [SnapClean.UNKNOWN_VOLUME]))
+        return [(name, baseFilter + [self.tagFilter(), {'Name': 'volume-id', 'Values': patterns}])
+                for name, patterns in slices]
+
+    def listPartitionedPages(self, partitions):
+        # Lists the partitions listConcurrency at a time, each on its own thread but all
+        # under the shared rate limiter, and merges their pages into one stream as they
+        # arrive.  The queue is bounded, so a slow consumer holds the listing threads back.
+        pages = queue.Queue(maxsize=2 * self.listConcurrency)
+        stopping = threading.Event()
+        seen = set() if self.PARTITIONS_OVERLAP else None
+
+        def put(item):
+            while not stopping.is_set():
+                try:
+                    pages.put(item, timeout=1.0)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def listPartition(index, name, targetFilter):
+            try:
+                for page in self.listSnapshotPages(targetFilter, index):
+                    if not put(('page', page)):
+                        return
+                put(('done', name))
+            except Exception as e:
+                put(('error', (name, e)))
+
+        self.logger.info('Listing %s partitions, %s at a time', len(partitions), self.listConcurrency)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.listConcurrency, thread_name_prefix='SnapCleanListing')
+        try:
+            for index, (name, targetFilter) in enumerate(partitions):
+                executor.submit(listPartition, index, name, targetFilter)
+            remaining = len(partitions)
+            while remaining:
+                kind, value = pages.get()
+                self.metrics.gauge('listingQueue', pages.qsize())
+                if kind == 'done':
+                    remaining -= 1
+                    self.logger.debug('Listed partition %s', value)
+                elif kind == 'error':
+                    name, e = value
+                    self.logger.error('Exception listing partition %s, %s', name, str(e))
+                    raise e
+                elif seen is None:
+                    yield value
+                else:
+                    # Keep the first sighting of each snapshot
+                    snapshots = []
+                    for snapshot in value['Snapshots']:
+                        if snapshot['SnapshotId'] not in seen:
+                            seen.add(snapshot['SnapshotId'])
+                            snapshots.append(snapshot)
+                    yield {'Snapshots': snapshots}
+        finally:
+            stopping.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def listPages(self, baseFilter):
+        if self.listConcurrency > 1:
+            return self.listPartitionedPages(self.listingPartitions(baseFilter))
+        return self.listSnapshotPages(baseFilter + [self.tagFilter()])
+
+    def getSnapshotRecords(self, pages):
+        # Fast path: DescribeSnapshots at its largest page size, keeping only a compact
+        # record per snapshot instead of a boto3 resource object
+        tagKeys = self.recordTagKeys()
+        for page in pages:
+            for snapshot in page['Snapshots']:
+                tags = None
+                if tagKeys:
+                    tags = [tag for tag in snapshot.get('Tags', []) if tag['Key'] in tagKeys]
+                yield SnapshotRecord(snapshot['SnapshotId'], snapshot['StartTime'], snapshot.get('VolumeId'), snapshot.get('VolumeSize'), tags)
+
+    def getSnapshotResources(self, ec2, pages):
+        # Loaded from the listed data, as a boto3 collection would, but paged by
+        # listSnapshotPages so failed pages are retried
+        for page in pages:
+            for item in page['Snapshots']:
+                snapshot = ec2.Snapshot(item['SnapshotId'])
+                snapshot.meta.data = item
+                yield snapshot
 
-    @retriable(attempts=5, sleeptime=15, jitter=0)
     def getFilteredSnapshots(self):
-        ec2 = boto3.resource("ec2", region_name=self.region)
-        targetFilter = [
+        # Lazy: pages are fetched, retried and alerted on by listSnapshotPages as they are consumed
+        baseFilter = [
             {
                 'Name': 'status',
                 'Values': ['completed']
@@ -134,44 +601,20 @@ class SnapClean(object):
             {
                 'Name': 'owner-id',
                 'Values': [self.account]
-            },
-            {
-                'Name': 'tag:' + self.tagKey,
-                'Values': [self.tagValue]
             }
         ]
 
-        try:
-            snapshot_iterator = ec2.snapshots.filter(Filters=targetFilter)
-            return snapshot_iterator
-        except Exception as e:
-            msg = "Exception filtering snapshots %s" % (str(e))
-            self.logger.error(msg)
-            snsSubject = 'SnapClean.py : Exception filtering snapshots'
-            snsMessage = '%s' % (str(e))
-            self.sns.sendSns(snsSubject, snsMessage)
+        if (self.fastListing is True):
+            return self.getSnapshotRecords(self.listPages(baseFilter))
+        ec2 = self.getEc2Resource()
+        return self.getSnapshotResources(ec2, self.listPages(baseFilter))
 
-    @retriable(attempts=5, sleeptime=15, jitter=0)
-    ### Return a list of snapshots associated with an AMI.
+    @retriable(attempts=5, sleeptime=15, jitter=5)
+    ### Return a dict of snapshot ids associated with an AMI, mapped to the AMI ids using them.
     def getInUseSnapshots(self):
-        ec2 = boto3.resource("ec2", region_name=self.region)
-        imageFilter = [
-            {
-                'Name': 'owner-id',
-                'Values': [self.account]
-            }
-        ]
-
-        InUseSnapShots = []
-
         try:
-            images = ec2.images.filter(Filters=imageFilter).all()
-            for image in images:
-                for snapshots in image.block_device_mappings:
-                    if 'Ebs' in snapshots:
-                        self.logger.info('Snapshot %s is in use with AMI %s', snapshots['Ebs']['SnapshotId'], image.id)
-                        InUseSnapShots.append(snapshots['Ebs']['SnapshotId'])
-            return InUseSnapShots
+            amiIndex = AmiUsageIndex.forRegion(self.account, self.region, self.amiCacheDir, self.amiCacheTtl)
+            return amiIndex.inUseSnapshots(self)
         except Exception as e:
             msg = "Exception filtering in-use snapshots %s" % (str(e))
             self.logger.error(msg)
@@ -179,192 +622,2567 @@ class SnapClean(object):
             snsMessage = '%s' % (str(e))
             self.sns.sendSns(snsSubject, snsMessage)
 
-    @retriable(attempts=5, sleeptime=5, jitter=0)
     def deleteSnapshot(self, snapshot):
-        snapshot.delete()
+        if isinstance(snapshot, SnapshotRecord):
+            self.throttle.call(self.getEc2Client().delete_snapshot, SnapshotId=snapshot.snapshot_id)
+        else:
+            self.throttle.call(snapshot.delete)
+
+    def shouldStop(self):
+        # Checked before each delete is queued: stop on a lost lease or a spent time budget
+        if self.lease is not None and self.lease.lost:
+            if not self.interrupted:
+                self.interrupted = True
+                self.logger.error('Lost lease %s, leaving the remaining deletes in journal %s', self.leaseName(), self.journalPath())
+            return True
+        if self.remainingTime is None or self.remainingTime() > self.reserveSeconds:
+            return False
+        if not self.interrupted:
+            self.interrupted = True
+            self.logger.warning('Time budget nearly spent, leaving the remaining deletes in journal %s', self.journalPath())
+        return True
+
+    def journalPath(self):
+        return self.fileStem() + '_SnapClean.journal'
+
+    def processExpiredSnapshot(self, idx, snapshot, results, resultsLock):
+        # Returns True once the snapshot no longer exists
+        self.logger.info("[#%s][Snapshot %s identified for deletion.", idx, snapshot.snapshot_id)
+        self.logger.debug("Tags: %s", snapshot.tags)
+
+        try:
+            if (self.dryRunFlag is False):
+                self.deleteSnapshot(snapshot)
+                with resultsLock:
+                    results[SnapClean.SNAPSHOTS_DELETED] = results[SnapClean.SNAPSHOTS_DELETED] + 1
+                self.decide(snapshot, 'deleted', 'expired')
+                return True
+            else:
+                self.logger.warning('Dryrun is set, snapshot %s will NOT be deleted', snapshot.snapshot_id)
+                self.decide(snapshot, 'dryrun', 'expired')
+        except ClientError as e:
+            if AdaptiveRateLimiter.errorCode(e) != SnapClean.SNAPSHOT_NOT_FOUND:
+                self.deleteFailed(snapshot, e, results, resultsLock)
+                return False
+            self.logger.info('Snapshot %s was already deleted', snapshot.snapshot_id)
+            self.decide(snapshot, 'deleted', SnapClean.SNAPSHOT_NOT_FOUND)
+            with resultsLock:
+                results[SnapClean.SNAPSHOTS_DELETED] = results[SnapClean.SNAPSHOTS_DELETED] + 1
+            return True
+        except Exception as e:
+            self.deleteFailed(snapshot, e, results, resultsLock)
+        return False
+
+    def deleteFailed(self, snapshot, e, results, resultsLock):
+        msg = "Exception deleting snapshot %s, %s" % (snapshot.snapshot_id, str(e))
+        self.logger.error(msg)
+        # Buffered into a digest, so a storm of failures doesn't become a storm of SNS calls
+        errorCode = AdaptiveRateLimiter.errorCode(e) if isinstance(e, ClientError) else type(e).__name__
+        self.sns.notifyEvent(errorCode, snapshot.snapshot_id, str(e))
+        self.decide(snapshot, 'failed', errorCode)
+        with resultsLock:
+            results[SnapClean.EXCEPTIONS_ENCOUNTERED] = results[SnapClean.EXCEPTIONS_ENCOUNTERED] + 1
+
+    def stateScope(self):
+        return '%s/%s/%s=%s%s' % (self.region, self.account, self.tagKey, self.tagValue, self.shardSuffix())
+
+    def shardSuffix(self):
+        return '' if self.shard is None else '_shard%sof%s' % self.shard
+
+    def fileStem(self):
+        # Log, journal and report files are per region and tag, per shard when sharded, and
+        # per account when running across accounts
+        accountPrefix = self.account + '_' if self.assumeRole else ''
+        return accountPrefix + self.region + '_' + self.tagValue + self.shardSuffix()
+
+    @staticmethod
+    def parseShard(shard):
+        # 'i/N' with 0 <= i < N
+        index, count = [int(part) for part in shard.split('/')]
+        if count < 1 or not 0 <= index < count:
+            raise ValueError('Shard %s is not of the form i/N with 0 <= i < N' % shard)
+        return index, count
+
+    def inShard(self, snapshot):
+        # crc32 rather than hash(), which is salted per process, so every worker agrees.
+        # By volume, all of a volume's snapshots land on the same worker.
+        key = snapshot.volume_id if self.shardBy == 'volume' and snapshot.volume_id else snapshot.snapshot_id
+        return zlib.crc32(key.encode()) % self.shard[1] == self.shard[0]
+
+    def shardFilter(self, snapshot_iterator):
+        if self.shard is None:
+            return snapshot_iterator
+        return (snapshot for snapshot in snapshot_iterator if self.inShard(snapshot))
+
+    def leaseName(self):
+        return '%s/%s/%s=%s%s' % (self.account, self.region, self.tagKey, self.tagValue, self.shardSuffix())
+
+    def policyHash(self):
+        # Identifies everything that decides which snapshots expire, so a plan can't be
+        # applied under different settings from the ones it was made with
+        return hashlib.sha256(json.dumps([self.account, self.region, self.tagKey, self.tagValue, self.policyDay,
+                                          self.policyWeek, self.policyMonth, self.retentionGroup, self.shard]).encode()).hexdigest()[:16]
+
+    def planPath(self, planFormat):
+        return self.fileStem() + '_SnapClean.plan.' + planFormat
+
+    def recheckAmiUsage(self, snapshotIds):
+        # Batched DescribeImages filtered on the planned snapshot ids, instead of indexing
+        # every AMI: returns {snapshot id: [AMI ids]} for planned snapshots now in use
+        inUse = {}
+        for start in range(0, len(snapshotIds), SnapClean.AMI_RECHECK_BATCH):
+            imageFilter = [
+                {'Name': 'owner-id', 'Values': [self.account]},
+                {'Name': 'block-device-mapping.snapshot-id', 'Values': snapshotIds[start:start + SnapClean.AMI_RECHECK_BATCH]}
+            ]
+            for page in self.throttledPages('describe_images', Filters=imageFilter):
+                for image in page['Images']:
+                    for mapping in image.get('BlockDeviceMappings', []):
+                        if 'Ebs' in mapping and 'SnapshotId' in mapping['Ebs']:
+                            inUse.setdefault(mapping['Ebs']['SnapshotId'], []).append(image['ImageId'])
+        return inUse
+
+    def loadState(self, stateStore, retentionIndex):
+        # Verdicts from the previous run can be reused for any snapshot whose start date
+        # has the same verdict under the previous day's index, provided the policy is unchanged.
+        policy, previousToday, verdicts = stateStore.load(self.stateScope())
+        if policy != '%s:%s:%s' % retentionIndex.policy or previousToday is None:
+            if verdicts:
+                self.logger.info('Retention policy changed since the last run, recomputing every verdict')
+            return {}, frozenset()
+
+        previousIndex = RetentionIndex.forPolicy(self.policyDay, self.policyWeek, self.policyMonth, previousToday)
+        firstOrdinal = min(previousIndex.startOrdinal, retentionIndex.startOrdinal)
+        lastOrdinal = retentionIndex.today.toordinal()
+        changedOrdinals = frozenset(ordinal for ordinal in range(firstOrdinal, lastOrdinal + 1)
+                                    if previousIndex.isRetained(date.fromordinal(ordinal)) != retentionIndex.isRetained(date.fromordinal(ordinal)))
+        self.logger.info('Loaded %s verdicts from the state store, last run %s', len(verdicts), previousToday.strftime(SnapClean.DATE_FORMAT))
+        return verdicts, changedOrdinals
+
+    def classifySnapshots(self, snapshot_iterator, in_use_snapshots, retentionIndex, results, stateRows=None, stateVerdicts=None, changedOrdinals=frozenset()):
+        # Generator yielding the expired snapshots, so the caller decides whether to
+        # collect them up front or stream them straight into the deletion engine.
+        # Snapshots are classified a page at a time against the retention index.  With a
+        # state store, unchanged verdicts from the previous run are reused rather than
+        # recomputed, and every verdict is appended to stateRows for the next run.
+        stateVerdicts = stateVerdicts or {}
+        snapshot_iterator = iter(snapshot_iterator)
+        while True:
+            page = list(itertools.islice(snapshot_iterator, SnapClean.SNAPSHOT_PAGE_SIZE))
+            if not page:
+                return
+
+            verdicts = []
+            recompute = []
+            for snapshot in page:
+                ordinal = snapshot.start_time.toordinal()
+                previous = stateVerdicts.get(snapshot.id)
+                if previous is not None and previous[0] == ordinal and ordinal not in changedOrdinals:
+                    verdicts.append(previous[1])
+                else:
+                    verdicts.append(None)
+                    recompute.append(snapshot.start_time)
+            recomputed = iter(retentionIndex.classify(recompute))
+
+            for snapshot, retained in zip(page, verdicts):
+                reused = retained is not None
+                if not reused:
+                    retained = next(recomputed)
+
+                # If the snapshot isn't in the in_use_snapshots index, continue.
+                if (snapshot.id not in in_use_snapshots):
+                    assert isinstance(snapshot.start_time, datetime), '%r is not a datetime' % snapshot.start_time
+                    results[SnapClean.TOTAL_SNAPSHOTS_FOUND] = results[SnapClean.TOTAL_SNAPSHOTS_FOUND] + 1
+                    if stateRows is not None:
+                        stateRows.append((snapshot.id, snapshot.start_time.toordinal(), int(retained)))
+                    if reused:
+                        results[SnapClean.VERDICTS_REUSED] = results[SnapClean.VERDICTS_REUSED] + 1
+                        self.logger.debug('Snapshot %s reused verdict %s from the state store', snapshot.id, 'retain' if retained else 'delete')
+                        if (not retained):
+                            results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] = results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] + 1
+                            self.decide(snapshot, 'expire', 'state')
+                            yield snapshot
+                        else:
+                            self.decide(snapshot, 'retain', 'state')
+                        continue
+
+                    results[SnapClean.VERDICTS_RECOMPUTED] = results[SnapClean.VERDICTS_RECOMPUTED] + 1
+                    self.logger.info('Snapshot %s is in-scope.', snapshot.id)
+                    if (not retained):
+                        self.logger.info('Snapshot %s with date %s is NOT in inclusionDatesList and will be deleted', snapshot.snapshot_id, snapshot.start_time)
+                        results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] = results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] + 1
+                        self.decide(snapshot, 'expire', 'policy')
+                        yield snapshot
+                    else:
+                        self.logger.info('Snapshot %s will be retained per retention policy specified', snapshot.snapshot_id)
+                        self.decide(snapshot, 'retain', 'policy')
+                else:
+                    self.logger.info('Inscope Snapshot %s is currently in use with AMI %s. ( %s )', snapshot.snapshot_id, ', '.join(in_use_snapshots[snapshot.id]), snapshot.description)
+                    self.decide(snapshot, 'retain', 'ami')
+                    results[SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = results[SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS] + 1
+
+    def classifyGrouped(self, snapshot_iterator, in_use_snapshots, retentionIndex, results):
+        # --retention-group: the policy is applied to each volume (or tag value) on its own,
+        # keeping the newest snapshot in each of its day, week and month buckets.  One sort by
+        # (group, start time) and one pass over the groups, so O(n log n) overall.  Needs the
+        # whole listing before the first verdict.
+        candidates = []
+        for snapshot in snapshot_iterator:
+            if (snapshot.id in in_use_snapshots):
+                self.logger.info('Inscope Snapshot %s is currently in use with AMI %s. ( %s )', snapshot.snapshot_id, ', '.join(in_use_snapshots[snapshot.id]), snapshot.description)
+                self.decide(snapshot, 'retain', 'ami')
+                results[SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = results[SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS] + 1
+                continue
+            candidates.append((self.retentionGroupKey(snapshot), snapshot.start_time, snapshot))
+
+        candidates.sort(key=lambda candidate: candidate[:2], reverse=True)
+        self.logger.info('Applying the retention policy to %s snapshots in %s groups', len(candidates),
+                         len(set(candidate[0] for candidate in candidates)))
+
+        for groupKey, group in itertools.groupby(candidates, key=lambda candidate: candidate[0]):
+            group = [candidate[2] for candidate in group]
+            verdicts = retentionIndex.retainNewestPerBucket([snapshot.start_time for snapshot in group])
+            for snapshot, retained in zip(group, verdicts):
+                results[SnapClean.TOTAL_SNAPSHOTS_FOUND] = results[SnapClean.TOTAL_SNAPSHOTS_FOUND] + 1
+                results[SnapClean.VERDICTS_RECOMPUTED] = results[SnapClean.VERDICTS_RECOMPUTED] + 1
+                if (not retained):
+                    self.logger.info('Snapshot %s with date %s is not the newest of a retained bucket of %s and will be deleted', snapshot.snapshot_id, snapshot.start_time, groupKey)
+                    results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] = results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] + 1
+                    self.decide(snapshot, 'expire', 'group')
+                    yield snapshot
+                else:
+                    self.logger.info('Snapshot %s will be retained for %s per retention policy specified', snapshot.snapshot_id, groupKey)
+                    self.decide(snapshot, 'retain', 'group')
+
+    def newResults(self):
+        return { SnapClean.TOTAL_SNAPSHOTS_FOUND: 0,
+                 SnapClean.EXPIRED_SNAPSHOTS_FOUND: 0,
+                 SnapClean.SNAPSHOTS_DELETED: 0,
+                 SnapClean.EXCEPTIONS_ENCOUNTERED: 0,
+                 SnapClean.TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS: 0,
+                 SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS: 0,
+                 SnapClean.VERDICTS_REUSED: 0,
+                 SnapClean.VERDICTS_RECOMPUTED: 0 }
+
+    def resumeDeletions(self):
+        # Continue the deletions journaled by an interrupted run, without relisting
+        startTime = datetime.now().replace(microsecond=0)
+
+        self.logger.info('============================================================================')
+
+        results = self.newResults()
+        remaining, planComplete = DeletionJournal.load(self.journalPath())
+        if remaining is None:
+            self.logger.info('No unfinished deletion journal %s, nothing to resume', self.journalPath())
+            return results
+        if not planComplete:
+            self.logger.warning('Journal %s was interrupted while still listing, run again without --resume to cover the rest', self.journalPath())
+
+        self.logger.info('Resuming %s journaled deletions from %s', len(remaining), self.journalPath())
+        results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] = len(remaining)
+
+        if (self.dryRunFlag is True):
+            self.logger.info('Dryrun option is set.  No deletions will occur')
+            journal = None
+        else:
+            journal = DeletionJournal(self.journalPath(), resume=True)
+
+        deletionEngine = DeletionEngine(self, self.concurrency, self.queueSize, journal)
+        with self.metrics.phase('deletion'):
+            deletionEngine.run(remaining, results)
+        self.sns.flush()
+
+        if journal is not None:
+            journal.close(complete=results[SnapClean.EXCEPTIONS_ENCOUNTERED] == 0 and not self.interrupted)
+
+        self.logSummary(results, startTime)
+        self.writeMetrics(results)
+        return results
+
+    def applyPlanDeletions(self):
+        # Delete exactly the snapshots of a reviewed plan: no listing or classification,
+        # only a re-check that none of them has since been registered in an AMI
+        startTime = datetime.now().replace(microsecond=0)
+
+        self.logger.info('============================================================================')
+
+        results = self.newResults()
+        planPath = next((self.planPath(planFormat) for planFormat in PlanFile.FORMATS if os.path.exists(self.planPath(planFormat))), None)
+        if planPath is None:
+            self.logger.error('No plan %s to apply', self.planPath('jsonl|csv'))
+            return results
+
+        rows = PlanFile.load(planPath)
+        policyHash = self.policyHash()
+        mismatched = [row for row in rows if row['policyHash'] != policyHash]
+        if mismatched:
+            self.logger.error('Plan %s was made with different settings (policy hash %s, now %s), not applying it',
+                              planPath, mismatched[0]['policyHash'], policyHash)
+            results[SnapClean.EXCEPTIONS_ENCOUNTERED] = 1
+            return results
+        self.logger.info('Applying %s planned deletions from %s', len(rows), planPath)
+
+        with self.metrics.phase('amiScan'):
+            in_use_snapshots = self.recheckAmiUsage([row['snapshotId'] for row in rows])
+        results[SnapClean.TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = len(in_use_snapshots)
+
+        planned = []
+        for row in rows:
+            snapshot = SnapshotRecord(row['snapshotId'], datetime.fromisoformat(row['startTime']), row['volumeId'] or None, None)
+            if snapshot.id in in_use_snapshots:
+                self.logger.warning('Planned Snapshot %s is now in use with AMI %s, skipping it', snapshot.id, ', '.join(in_use_snapshots[snapshot.id]))
+                self.decide(snapshot, 'retain', 'ami')
+                results[SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = results[SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS] + 1
+                continue
+            planned.append(snapshot)
+        results[SnapClean.EXPIRED_SNAPSHOTS_FOUND] = len(planned)
+
+        if (self.dryRunFlag is True):
+            self.logger.info('Dryrun option is set.  No deletions will occur')
+            journal = None
+        else:
+            journal = DeletionJournal(self.journalPath())
+            journal.planAll(planned)
+
+        deletionEngine = DeletionEngine(self, self.concurrency, self.queueSize, journal)
+        with self.metrics.phase('deletion'):
+            deletionEngine.run(planned, results)
+        self.sns.flush()
+
+        if journal is not None:
+            journal.close(complete=results[SnapClean.EXCEPTIONS_ENCOUNTERED] == 0 and not self.interrupted)
+
+        self.logSummary(results, startTime)
+        self.writeMetrics(results)
+        return results
+
+    def execute(self, snapshot_iterator=None, in_use_snapshots=None):
+        self.interrupted = False
+
+        # With --lock, the whole run holds the job's lease; a run that can't get it does nothing
+        if self.lockSpec:
+            # Leases live with the ambient credentials, not in each assumed account
+            self.lease = LeaseLock.fromSpec(self.lockSpec, self.leaseName(), self.lockTtl, self.logger)
+            if not self.lease.acquire():
+                self.logger.warning('Lease %s is held by %s, skipping this run', self.leaseName(), self.lease.holder)
+                self.lease = None
+                return self.newResults()
+        try:
+            return self.executeJob(snapshot_iterator, in_use_snapshots)
+        finally:
+            if self.lease is not None:
+                self.lease.release()
+                self.lease = None
+
+    def executeJob(self, snapshot_iterator=None, in_use_snapshots=None):
+        if (self.resumeFlag is True):
+            return self.resumeDeletions()
+        if (self.applyPlan is True):
+            return self.applyPlanDeletions()
 
-    def execute(self):
         # Log the duration of the processing
         startTime = datetime.now().replace(microsecond=0)
 
         self.logger.info('============================================================================')
 
-        snapshot_iterator = iter([])
-        snapshot_iterator = self.getFilteredSnapshots()
+        # A batch run passes in its shared listing and AMI index
+        if snapshot_iterator is None:
+            with self.metrics.phase('listing'):
+                snapshot_iterator = self.metrics.timedIterator('listing', self.shardFilter(self.getFilteredSnapshots()))
 
         # Step #2: Collect all snapshots older than retentionTime
-        TOTAL_SNAPSHOTS_FOUND = 'totalSnapshotsFound'
-        EXPIRED_SNAPSHOTS_FOUND = 'expiredSnapshotsFound'
-        SNAPSHOTS_DELETED = 'deletedSnapshots'
-        EXCEPTIONS_ENCOUNTERED = 'exceptionsEncountered'
-        TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS = 'totalSnapshotsAssociatedWithAMIs'
-        TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS = 'totalInscopeSnapshotsAssociatedWithAMIs'
-
-        results = { TOTAL_SNAPSHOTS_FOUND: 0,
-                    EXPIRED_SNAPSHOTS_FOUND: 0,
-                    SNAPSHOTS_DELETED: 0,
-                    EXCEPTIONS_ENCOUNTERED: 0,
-                    TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS: 0,
-                    TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS: 0 }
+        results = self.newResults()
 
         # Go get a list of current snapshots associated to an AMI
-        in_use_snapshots = self.getInUseSnapshots()
-        results[TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = len(in_use_snapshots)
-                
-        expiredSnapshots = []
+        if in_use_snapshots is None:
+            with self.metrics.phase('amiScan'):
+                in_use_snapshots = self.getInUseSnapshots()
+        results[SnapClean.TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = len(in_use_snapshots)
 
-        inclusionDatesList = self.generateInclusionDatesList()
+        with self.metrics.phase('retention'):
+            retentionIndex = self.generateRetentionIndex()
 
-        for item in inclusionDatesList:
-            self.logger.info(item.strftime(SnapClean.DATE_FORMAT))
+        if self.logger.isEnabledFor(logging.INFO):
+            for item in retentionIndex.retainedDates():
+                self.logger.info(item.strftime(SnapClean.DATE_FORMAT))
 
-        inscope_inuse_snapshots = []
-        inscope_inuse_snapshots_count = 0
+        stateStore = None
+        stateRows = None
+        stateVerdicts = {}
+        changedOrdinals = frozenset()
+        if self.stateDb and self.retentionGroup:
+            # Verdicts depend on the rest of the group, so they can't be reused one by one
+            self.logger.warning('--state-db is not used with --retention-group, every verdict is recomputed')
+        elif self.stateDb:
+            with self.metrics.phase('state'):
+                stateStore = StateStore(self.stateDb)
+                stateRows = []
+                stateVerdicts, changedOrdinals = self.loadState(stateStore, retentionIndex)
 
-        for snapshot in snapshot_iterator:
-            # If the snapshot isn't in the in_use_snapshots list, continue.
-            if (snapshot.id not in str(in_use_snapshots)):
-                self.logger.info('Snapshot %s is in-scope.', snapshot.id)
-                assert isinstance(snapshot.start_time, datetime), '%r is not a datetime' % snapshot.start_time
-                results[TOTAL_SNAPSHOTS_FOUND] = results[TOTAL_SNAPSHOTS_FOUND] + 1
-                snapshotStartDateTime = snapshot.start_time.date()
-                if (snapshotStartDateTime not in inclusionDatesList):
-                    self.logger.info('Snapshot %s with date %s is NOT in inclusionDatesList and will be deleted' % (str(snapshot.snapshot_id), str(snapshot.start_time.strftime("%c %Z"))))
-                    expiredSnapshots.append(snapshot)
-                else:
-                    self.logger.info('Snapshot %s will be retained per retention policy specified', snapshot.snapshot_id)
-            else:
-                self.logger.info('Inscope Snapshot %s is currently in use with an AMI. ( %s )', snapshot.snapshot_id, snapshot.description)
-                inscope_inuse_snapshots.append(snapshot)
+        # With --write-plan, every expired snapshot is also written to the plan as it is classified
+        if self.planFormat:
+            self.planWriter = PlanFile(self.planPath(self.planFormat), self.planFormat, self.policyHash())
 
-        results[TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = len(inscope_inuse_snapshots)
-        results[EXPIRED_SNAPSHOTS_FOUND] = len(expiredSnapshots)
+        if self.retentionGroup:
+            expiredSnapshots = self.metrics.timedIterator('classification', self.classifyGrouped(
+                snapshot_iterator, in_use_snapshots, retentionIndex, results))
+        else:
+            expiredSnapshots = self.metrics.timedIterator('classification', self.classifySnapshots(
+                snapshot_iterator, in_use_snapshots, retentionIndex, results, stateRows, stateVerdicts, changedOrdinals))
+
+        # Write ahead journal of planned and completed deletes, so an interrupted run can --resume
+        journal = None
+        if (self.dryRunFlag is False):
+            journal = DeletionJournal(self.journalPath())
+
+        # Unless streaming, finish the listing before any deletes begin
+        if (self.streamFlag is False):
+            expiredSnapshots = list(expiredSnapshots)
+            if journal is not None:
+                journal.planAll(expiredSnapshots)
 
         # Step #3: Delete snapshots in Collection, unless dryRunFlag is set
         if (self.dryRunFlag is True):
             self.logger.info('Dryrun option is set.  No deletions will occur')
 
-        iteration_count = 0
-        iteration_sleep_seconds = 1 * 30      # 30 second backoff
-        for snapshot in expiredSnapshots:
-            iteration_count += 1
-            # Since this loop will generate a large number of API calls within a tight timeframe,
-            # we are susceptible to RequestLimitExceeded, which not only affects this process,
-            # but all AWS API calls within a region.  As such, we will back off with a sleep every 100 calls
-            if(iteration_count % 70 == 0):
-                self.logger.info('Backing off '+str(iteration_sleep_seconds)+' seconds every 100 snapshot deletes to avoid API limits.  Zzzzz.....')
-                time.sleep(iteration_sleep_seconds)
-
-            self.logger.info("[#%(idx)s][Snapshot %(vol)s identified for deletion." % {
-                'idx':  str(iteration_count),
-                'vol':  str(snapshot.snapshot_id)
-            })
-            self.logger.debug("Tags: %(tags)s" % {
-                'tags':  str(snapshot.tags)
-            })
+        deletionEngine = DeletionEngine(self, self.concurrency, self.queueSize, journal)
+        with self.metrics.phase('deletion'):
+            deletionEngine.run(expiredSnapshots, results)
+        self.sns.flush()
 
-            try:
-                if (self.dryRunFlag is False):
-                    self.deleteSnapshot(snapshot)
-                    results[SNAPSHOTS_DELETED] = results[SNAPSHOTS_DELETED] + 1
+        if self.planWriter is not None:
+            self.planWriter.close()
+            self.logger.info('Plan of %s deletions written to %s', results[SnapClean.EXPIRED_SNAPSHOTS_FOUND], self.planWriter.path)
+            self.planWriter = None
+
+        if journal is not None:
+            journal.close(complete=results[SnapClean.EXCEPTIONS_ENCOUNTERED] == 0 and not self.interrupted)
+
+        if stateStore is not None:
+            with self.metrics.phase('state'):
+                stateStore.save(self.stateScope(), '%s:%s:%s' % retentionIndex.policy, retentionIndex.today, stateRows)
+                stateStore.close()
+
+        self.logSummary(results, startTime)
+        self.writeMetrics(results)
+        return results
+
+    def metricsLabels(self):
+        labels = {'region': self.region, 'tag': self.tagValue}
+        if self.assumeRole:
+            labels['account'] = self.account
+        if self.shard is not None:
+            labels['shard'] = '%s/%s' % self.shard
+        return labels
+
+    def resetMetrics(self):
+        # Before another run of a reused instance, so its report covers that run alone
+        self.metrics.reset()
+        self.throttle.resetCounters()
+
+    def writeMetrics(self, results):
+        # Batch jobs share the batch's metrics, which the batch reports once
+        if not self.exportMetrics:
+            return
+        self.metrics.event('throttle', self.throttle.throttleEvents - self.metrics.events.get('throttle', 0))
+        self.metrics.event('throttleRetry', self.throttle.retries - self.metrics.events.get('throttleRetry', 0))
+        self.metrics.gauge('apiRate', self.throttle.currentRate())
+        if self.metricsFlag:
+            self.metrics.writeReport(self.fileStem() + '_SnapClean.metrics.json', self.metricsLabels(), results)
+        if self.prometheusDir:
+            self.metrics.writePrometheus(os.path.join(self.prometheusDir, 'snapclean_' + self.fileStem() + '.prom'),
+                                         self.metricsLabels(), results)
+
+    def inventoryPath(self):
+        return self.fileStem() + '_SnapClean.inventory.csv'
+
+    def simulationPath(self):
+        return self.fileStem() + '_SnapClean.simulation.csv'
+
+    def loadInventory(self, inventoryPath=None):
+        # Yields (group, start date ordinal) of every snapshot that could expire: the rows
+        # of a plan or inventory file, or the live listing without AMI-backed snapshots,
+        # which is saved as an inventory file for later offline sweeps.
+        if inventoryPath:
+            self.logger.info('Simulating over the inventory in %s', inventoryPath)
+            # Start times are written in UTC, so their date part is the UTC start date
+            ordinals = {}
+            for snapshotId, volumeId, startTime in PlanFile.rows(inventoryPath, ('snapshotId', 'volumeId', 'startTime')):
+                day = startTime[:10]
+                ordinal = ordinals.get(day)
+                if ordinal is None:
+                    ordinal = ordinals[day] = date.fromisoformat(day).toordinal()
+                if self.retentionGroup:
+                    yield self.retentionGroupKey(SnapshotRecord(snapshotId, None, volumeId or None, None)), ordinal
                 else:
-                    self.logger.warning('Dryrun is set, snapshot %s will NOT be deleted' % snapshot.snapshot_id)
-            except Exception as e:
-                msg = "Exception deleting snapshot %s, %s" % (snapshot.snapshot_id, str(e))
-                self.logger.error(msg)
-                snsSubject = 'SnapClean.py : Exception deleting snapshot %s' % (snapshot.snapshot_id)
-                snsMessage = '%s' % (str(e))
-                self.sns.sendSns(snsSubject, snsMessage)
-                results[EXCEPTIONS_ENCOUNTERED] = results[EXCEPTIONS_ENCOUNTERED] + 1
+                    yield self.tagValue, ordinal
+            return
+        with self.metrics.phase('amiScan'):
+            in_use_snapshots = self.getInUseSnapshots()
+        inventory = PlanFile(self.inventoryPath(), 'csv', self.policyHash())
+        try:
+            for snapshot in self.shardFilter(self.getFilteredSnapshots()):
+                if snapshot.id in in_use_snapshots:
+                    continue
+                inventory.write(snapshot, 'inventory')
+                yield self.simulationGroup(snapshot), snapshot.start_time.toordinal()
+        finally:
+            inventory.close()
+
+    def simulationGroup(self, snapshot):
+        # Expiries are broken down by retention group, or reported for the job as a whole
+        return self.retentionGroupKey(snapshot) if self.retentionGroup else self.tagValue
+
+    def simulate(self, days, policies, inventoryPath=None):
+        # Forward simulation of the deletes each candidate Day:Week:Month policy would make
+        # on each of the next `days` days.  Writes <stem>_SnapClean.simulation.csv with a row
+        # per policy, day and group with expiries (group '*' for the day's total), and logs
+        # each policy's peak day and the hours it needs at the current --rate.
+        startTime = datetime.now().replace(microsecond=0)
+        today = self.currentDate()
 
+        with self.metrics.phase('listing'):
+            if self.retentionGroup:
+                groups = {}
+                for group, ordinal in self.loadInventory(inventoryPath):
+                    groups.setdefault(group, []).append(ordinal)
+                # Each group is reduced to its distinct dates, newest first, plus a count of
+                # the extra same-day snapshots, and identical date patterns are pooled
+                patterns = {}
+                for group, ordinals in groups.items():
+                    distinct = tuple(sorted(set(ordinals), reverse=True))
+                    patterns.setdefault(distinct, []).append((group, len(ordinals) - len(distinct)))
+                total = sum(len(ordinals) for ordinals in groups.values())
+                self.logger.info('Simulating %s snapshots in %s groups with %s distinct date patterns', total, len(groups), len(patterns))
+                del groups
+            else:
+                counts = collections.Counter(self.loadInventory(inventoryPath))
+                ordinals = set(ordinal for group, ordinal in counts)
+                self.logger.info('Simulating %s snapshots over %s distinct start dates', sum(counts.values()), len(ordinals))
+
+        summaries = []
+        with self.metrics.phase('retention'), open(self.simulationPath(), 'w', newline='') as simulationFile:
+            writer = csv.writer(simulationFile)
+            writer.writerow(('policy', 'day', 'date', 'group', 'expiring'))
+            for policy in policies:
+                policyDay, policyWeek, policyMonth = SnapClean.parsePolicy(policy)
+                simulator = RetentionSimulator(policyDay, policyWeek, policyMonth, today, days)
+                byGroup = {}
+                if self.retentionGroup:
+                    for distinct, members in patterns.items():
+                        expiries = simulator.groupExpiries(distinct)
+                        for group, duplicates in members:
+                            groupCounts = list(expiries)
+                            groupCounts[0] += duplicates
+                            byGroup[group] = groupCounts
+                else:
+                    expiries = simulator.flatExpiries(ordinals)
+                    for (group, ordinal), count in counts.items():
+                        day = expiries.get(ordinal)
+                        if day is not None:
+                            byGroup.setdefault(group, [0] * (days + 1))[day] += count
+
+                totals = [0] * (days + 1)
+                for groupCounts in byGroup.values():
+                    for day, count in enumerate(groupCounts):
+                        totals[day] += count
+                for day in range(days + 1):
+                    dayDate = (today + timedelta(days=day)).isoformat()
+                    writer.writerow((policy, day, dayDate, '*', totals[day]))
+                    for group in sorted(byGroup):
+                        if byGroup[group][day]:
+                            writer.writerow((policy, day, dayDate, group, byGroup[group][day]))
+                summaries.append((policy, totals))
+
+        for policy, totals in summaries:
+            peakDay = max(range(days + 1), key=lambda day: totals[day])
+            self.logger.info('Policy %s : %s expire over the next %s days, %s today, peak %s on %s (day %s)',
+                             policy, sum(totals), days, totals[0], totals[peakDay],
+                             (today + timedelta(days=peakDay)).isoformat(), peakDay)
+            if self.rate > 0:
+                self.logger.info('Policy %s : the peak day takes %.1f hours of deletes at %s requests/sec',
+                                 policy, totals[peakDay] / self.rate / 3600.0, self.rate)
+        finishTime = datetime.now().replace(microsecond=0)
+        self.logger.info('Simulation of %s policies written to %s in %s seconds', len(policies), self.simulationPath(), str(finishTime - startTime))
+        return dict(summaries)
+
+    def logSummary(self, results, startTime):
         # capture completion time
         finishTime = datetime.now().replace(microsecond=0)
 
         self.logger.info('============================================================================')
-        self.logger.info('Total Snapshots inspected %s', results[TOTAL_SNAPSHOTS_FOUND])
-        self.logger.info('Expired Snapshots %s', results[EXPIRED_SNAPSHOTS_FOUND])
-        self.logger.info('Deleted Snapshots %s', results[SNAPSHOTS_DELETED])
-        self.logger.info('Total Snapshots in use with AMIs : %s', results[TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS])
-        self.logger.info('Total In-scope Snapshots currently in use with an AMI : %s', results[TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS])
-        self.logger.info('Exceptions Encountered %s', results[EXCEPTIONS_ENCOUNTERED])
+        self.logger.info('Total Snapshots inspected %s', results[SnapClean.TOTAL_SNAPSHOTS_FOUND])
+        self.logger.info('Expired Snapshots %s', results[SnapClean.EXPIRED_SNAPSHOTS_FOUND])
+        self.logger.info('Deleted Snapshots %s', results[SnapClean.SNAPSHOTS_DELETED])
+        self.logger.info('Total Snapshots in use with AMIs : %s', results[SnapClean.TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS])
+        self.logger.info('Total In-scope Snapshots currently in use with an AMI : %s', results[SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS])
+        self.logger.info('Exceptions Encountered %s', results[SnapClean.EXCEPTIONS_ENCOUNTERED])
+        if self.stateDb:
+            self.logger.info('Verdicts reused %s, recomputed %s', results[SnapClean.VERDICTS_REUSED], results[SnapClean.VERDICTS_RECOMPUTED])
+        self.logger.info('API rate at completion %s requests/sec ( %s throttle events )', self.throttle.currentRate(), self.throttle.throttleEvents)
+        self.logger.info('Phase seconds: %s', ', '.join('%s %.2f' % item for item in self.metrics.phaseSeconds().items()))
+        if self.interrupted:
+            self.logger.info('Stopped early on the time budget, the remaining deletes are left in %s', self.journalPath())
         self.logger.info('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
         self.logger.info('++ Completed processing for workload in ' + str(finishTime - startTime) + ' seconds')
         self.logger.info('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
 
 
-class SnsNotifier(object):
-    def __init__(self, topic):
-        self.topic = topic
+class AmiUsageIndex(object):
+    # AMI id -> snapshot ids for one account and region.  With a cache directory it is
+    # persisted there and shared by every job in the process using the same directory and
+    # ttl; until it is ttl seconds old it is used as is.  Without one each run scans afresh,
+    # so a warm Lambda container never checks expiry against an older run's AMIs.  A refresh still has to page through DescribeImages, as EC2 has no
+    # cheaper way to list image ids, but only images not already indexed have their block
+    # device mappings walked (an AMI's mappings never change), and images that no longer
+    # exist are evicted.  A stale index is safe: EC2 refuses to delete a snapshot that a
+    # registered AMI uses.
+    registry = {}
+    registryLock = threading.Lock()
 
-    @retriable(attempts=5, sleeptime=10, jitter=0)
-    def sendSns(self, subject, message):
-        client = boto3.resource('sns')
-        topic = client.create_topic(Name=self.topic)
-        topic.publish(Subject=subject, Message=str(message))
+    def __init__(self, account, region, cacheDir, ttl):
+        self.account = account
+        self.region = region
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.images = {}
+        self.refreshed = None
+        self.snapshotIndex = {}
+        self.cachePath = None
+        if cacheDir:
+            self.cachePath = os.path.join(cacheDir, '%s_%s_ami_index.json' % (account, region))
+            self.load()
 
+    @classmethod
+    def forRegion(cls, account, region, cacheDir=None, ttl=0):
+        if not cacheDir:
+            return cls(account, region, None, 0)
+        key = (account, region, cacheDir, ttl)
+        with cls.registryLock:
+            if key not in cls.registry:
+                cls.registry[key] = cls(account, region, cacheDir, ttl)
+            return cls.registry[key]
 
-if __name__ == "__main__":
+    def load(self):
+        if not os.path.exists(self.cachePath):
+            return
+        with open(self.cachePath) as cacheFile:
+            cached = json.load(cacheFile)
+        self.images = cached['images']
+        self.refreshed = cached['refreshed']
+        self.buildSnapshotIndex()
 
-    parser = argparse.ArgumentParser(description='Command line parser')
-    parser.add_argument('-r', '--region',
-                        help='AWS Region indicator', required=True)
-    parser.add_argument('-p', '--policy',
-                        help='Retention period for the snapshots. Retention based on the following notation Day:Week:Month eg. 7:5:12 would retain 7 daily, 5 weekly and 12 monthly',
-                        required=True)
-    parser.add_argument('-k', '--tagKey',
-                        help='The name of the Tag Key used for snapshot searches',
-                        required=True)
-    parser.add_argument('-v', '--tagValue',
-                        help='The Tag Value used to match snapshot searches',
-                        required=True)
-    parser.add_argument('-a', '--account',
-                        help='AWS account number',
-                        required=True)
-    parser.add_argument('-d', '--dryrun', action='count',
-                        help='Run but take no Action',
-                        required=False)
-    parser.add_argument('-l', '--loglevel',
-                        choices=[
-                            'critical',
-                            'error',
-                            'warning',
-                            'info',
-                            'debug',
-                            'notset'
-                            ],
-                        help='The level to record log messages to the logfile',
-                        required=False)
+    def save(self):
+        # Write then rename, so a concurrent reader never sees a partial file
+        tmpPath = self.cachePath + '.tmp'
+        with open(tmpPath, 'w') as cacheFile:
+            json.dump({'refreshed': self.refreshed, 'images': self.images}, cacheFile)
+        os.replace(tmpPath, self.cachePath)
 
-    args = parser.parse_args()
+    def buildSnapshotIndex(self):
+        # Keyed by snapshot id so membership checks in execute() are O(1)
+        snapshotIndex = {}
+        for imageId, snapshotIds in self.images.items():
+            for snapshotId in snapshotIds:
+                snapshotIndex.setdefault(snapshotId, []).append(imageId)
+        self.snapshotIndex = snapshotIndex
 
-    # Log level
-    if args.loglevel:
-        loglevel = args.loglevel
-    else:
-        loglevel = 'info'
+    def isFresh(self):
+        return self.refreshed is not None and time.time() - self.refreshed < self.ttl
 
-    # Dryrun Flag
-    if args.dryrun:
-        dryRun = True
-    else:
-        dryRun = False
+    def refresh(self, snapClean):
+        imageFilter = [
+            {
+                'Name': 'owner-id',
+                'Values': [self.account]
+            }
+        ]
+        images = {}
+        added = 0
+        for page in snapClean.throttledPages('describe_images', Filters=imageFilter):
+            for image in page['Images']:
+                imageId = image['ImageId']
+                if imageId in self.images:
+                    images[imageId] = self.images[imageId]
+                    continue
+                added += 1
+                snapshotIds = []
+                for mapping in image.get('BlockDeviceMappings', []):
+                    if 'Ebs' in mapping and 'SnapshotId' in mapping['Ebs']:
+                        snapClean.logger.info('Snapshot %s is in use with AMI %s', mapping['Ebs']['SnapshotId'], imageId)
+                        snapshotIds.append(mapping['Ebs']['SnapshotId'])
+                images[imageId] = snapshotIds
+
+        removed = len(set(self.images) - set(images))
+        self.images = images
+        self.refreshed = time.time()
+        self.buildSnapshotIndex()
+        if self.cachePath:
+            self.save()
+        snapClean.logger.info('AMI index refreshed: %s images, %s new, %s removed', len(images), added, removed)
+
+    def inUseSnapshots(self, snapClean):
+        with self.lock:
+            if self.isFresh():
+                snapClean.logger.info('Using cached AMI index of %s images', len(self.images))
+            else:
+                self.refresh(snapClean)
+            return self.snapshotIndex
+
+
+class RetentionIndex(object):
+    # The dates a Day:Week:Month policy retains as of `today`, held as a bitmap over date
+    # ordinals so a membership test is O(1).  Equivalent to running grandfatherson's
+    # dates_to_keep over every day of the policy's range, but built directly: within each
+    # filter's window, every day/week/month bucket keeps its oldest day in the range.
+    cache = {}
+    cacheLock = threading.Lock()
+
+    def __init__(self, policyDay, policyWeek, policyMonth, today):
+        self.policy = (policyDay, policyWeek, policyMonth)
+        self.today = today
+        self.startDate = RetentionIndex.rangeStart(policyDay, policyWeek, policyMonth, today)
+        if self.startDate is None:
+            raise ValueError('No policy values specified')
+        self.startOrdinal = self.startDate.toordinal()
+        self.bitmap = bytearray(today.toordinal() - self.startOrdinal + 1)
+
+        if policyDay > 0:
+            self.keepBuckets(today - timedelta(days=policyDay - 1),
+                             lambda d: d,
+                             lambda d: d + timedelta(days=1))
+        if policyWeek > 0:
+            self.keepBuckets(RetentionIndex.weekStart(today) - timedelta(weeks=policyWeek - 1),
+                             RetentionIndex.weekStart,
+                             lambda d: d + timedelta(weeks=1))
+        if policyMonth > 0:
+            from dateutil.relativedelta import relativedelta
+            self.keepBuckets(today.replace(day=1) - relativedelta(months=policyMonth - 1),
+                             lambda d: d.replace(day=1),
+                             lambda d: d + relativedelta(months=1))
+
+    @staticmethod
+    def rangeStart(policyDay, policyWeek, policyMonth, today):
+        # The range is sized by the longest unit in the policy
+        from dateutil.relativedelta import relativedelta
+        if policyMonth > 0:
+            return today - relativedelta(months=policyMonth)
+        elif policyWeek > 0:
+            return today - relativedelta(weeks=policyWeek)
+        elif policyDay > 0:
+            return today - relativedelta(days=policyDay)
+        return None
+
+    @staticmethod
+    def weekStart(d):
+        # Weeks start on Saturday, matching the firstweekday passed to grandfatherson
+        return d - timedelta(days=(d.weekday() - SATURDAY) % 7)
+
+    @classmethod
+    def forPolicy(cls, policyDay, policyWeek, policyMonth, today):
+        key = (policyDay, policyWeek, policyMonth, today)
+        with cls.cacheLock:
+            if key not in cls.cache:
+                cls.cache[key] = cls(policyDay, policyWeek, policyMonth, today)
+            return cls.cache[key]
+
+    def keepBuckets(self, windowStart, bucketOf, nextBucket):
+        first = max(self.startDate, windowStart)
+        bucket = bucketOf(first)
+        while bucket <= self.today:
+            self.bitmap[max(first, bucket).toordinal() - self.startOrdinal] = 1
+            bucket = nextBucket(bucket)
+
+    def isRetained(self, d):
+        return self.isRetainedOrdinal(d.toordinal())
+
+    def isRetainedOrdinal(self, ordinal):
+        offset = ordinal - self.startOrdinal
+        return 0 <= offset < len(self.bitmap) and self.bitmap[offset] == 1
+
+    def retainNewestPerBucket(self, startTimes):
+        # Verdicts for one group's start times, sorted newest first: a snapshot is retained
+        # if it is the newest in the range of a day, week or month bucket inside that
+        # filter's window.  Buckets and windows are the ones keepBuckets uses.
+        policyDay, policyWeek, policyMonth = self.policy
+        todayOrdinal = self.today.toordinal()
+        firstDay = todayOrdinal - policyDay + 1 if policyDay > 0 else None
+        firstWeek = RetentionIndex.weekStart(self.today).toordinal() - 7 * (policyWeek - 1) if policyWeek > 0 else None
+        firstMonth = self.today.year * 12 + self.today.month - 1 - (policyMonth - 1) if policyMonth > 0 else None
+
+        seen = set()
+        verdicts = []
+        for startTime in startTimes:
+            ordinal = startTime.toordinal()
+            retained = False
+            if self.startOrdinal <= ordinal <= todayOrdinal:
+                if firstDay is not None and ordinal >= firstDay and ('d', ordinal) not in seen:
+                    seen.add(('d', ordinal))
+                    retained = True
+                if firstWeek is not None:
+                    # Weeks start on Saturday; date.fromordinal(o).weekday() == (o + 6) % 7
+                    week = ordinal - (ordinal + 6 - SATURDAY) % 7
+                    if week >= firstWeek and ('w', week) not in seen:
+                        seen.add(('w', week))
+                        retained = True
+                if firstMonth is not None:
+                    month = startTime.year * 12 + startTime.month - 1
+                    if month >= firstMonth and ('m', month) not in seen:
+                        seen.add(('m', month))
+                        retained = True
+            verdicts.append(retained)
+        return verdicts
+
+    def classify(self, startTimes):
+        # Verdicts for a whole page of snapshot start times: True where retained
+        bitmap = self.bitmap
+        size = len(bitmap)
+        startOrdinal = self.startOrdinal
+        verdicts = []
+        for startTime in startTimes:
+            offset = startTime.toordinal() - startOrdinal
+            verdicts.append(0 <= offset < size and bitmap[offset] == 1)
+        return verdicts
+
+    def retainedDates(self):
+        return [self.startDate + timedelta(days=offset) for offset, kept in enumerate(self.bitmap) if kept]
+
+
+class RetentionSimulator(object):
+    # Replays a policy over the next `days` days against a fixed inventory, as daily runs
+    # would: a snapshot expires on the first day it isn't retained.  Snapshots taken after
+    # the inventory are not modelled.  Work is shared between snapshots with the same
+    # start dates: flat policies are evaluated once per distinct start date, grouped ones
+    # once per distinct sequence of start dates in a group, so sweeping many policies over
+    # a large inventory only costs as much as its distinct dates and date patterns.
+    def __init__(self, policyDay, policyWeek, policyMonth, today, days):
+        self.policy = (policyDay, policyWeek, policyMonth)
+        self.today = today
+        self.days = days
+        self.indexes = [RetentionIndex(policyDay, policyWeek, policyMonth, today + timedelta(days=day)) for day in range(days + 1)]
+        self.groupCache = {}
+
+    def flatExpiries(self, ordinals):
+        # {start date ordinal: day its snapshots expire}, without the dates that outlast the horizon
+        expiries = {}
+        alive = set(ordinals)
+        for day, index in enumerate(self.indexes):
+            expired = [ordinal for ordinal in alive if not index.isRetainedOrdinal(ordinal)]
+            for ordinal in expired:
+                expiries[ordinal] = day
+            alive.difference_update(expired)
+        return expiries
+
+    def groupExpiries(self, ordinals):
+        # Expiries per day of one group, given its distinct start date ordinals newest first.
+        # Further snapshots from an already listed date are never the newest in any of its
+        # buckets, so they always expire on day 0 and are left to the caller.
+        counts = self.groupCache.get(ordinals)
+        if counts is None:
+            counts = [0] * (self.days + 1)
+            alive = [date.fromordinal(ordinal) for ordinal in ordinals]
+            for day, index in enumerate(self.indexes):
+                verdicts = index.retainNewestPerBucket(alive)
+                kept = [d for d, retained in zip(alive, verdicts) if retained]
+                counts[day] = len(alive) - len(kept)
+                alive = kept
+                if not alive:
+                    break
+            self.groupCache[ordinals] = counts
+        return counts
 
-    # Launch SnapClean
-    policy_split = args.policy.split(":")
 
-    snapCleanMain = SnapClean(
-        args.region,
-        int(policy_split[0]),
-        int(policy_split[1]),
-        int(policy_split[2]),
-        args.tagKey,
-        args.tagValue,
-        args.account,
-        loglevel,
-        dryRun
-        )
+class StateStore(object):
+    # SQLite record of each snapshot's start date and last verdict, per
+    # region/account/tag scope, along with the policy and day they were computed for.
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS runs (scope TEXT PRIMARY KEY, policy TEXT, today INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS verdicts (scope TEXT, snapshot_id TEXT, start_ordinal INTEGER, '
+                                'retained INTEGER, PRIMARY KEY (scope, snapshot_id))')
+        self.connection.commit()
 
-    snapCleanMain.snsInit()
+    def load(self, scope):
+        # Returns (policy, today, {snapshot id: (start date ordinal, retained)})
+        row = self.connection.execute('SELECT policy, today FROM runs WHERE scope = ?', (scope,)).fetchone()
+        if row is None:
+            return None, None, {}
+        verdicts = {}
+        for snapshotId, startOrdinal, retained in self.connection.execute(
+                'SELECT snapshot_id, start_ordinal, retained FROM verdicts WHERE scope = ?', (scope,)):
+            verdicts[snapshotId] = (startOrdinal, bool(retained))
+        return row[0], date.fromordinal(row[1]), verdicts
 
-    snapCleanMain.execute()
+    def save(self, scope, policy, today, rows):
+        # Replace the scope's verdicts with this run's, dropping snapshots that have gone
+        with self.connection:
+            self.connection.execute('DELETE FROM verdicts WHERE scope = ?', (scope,))
+            self.connection.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)',
+                                        ((scope, snapshotId, startOrdinal, retained) for snapshotId, startOrdinal, retained in rows))
+            self.connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)', (scope, policy, today.toordinal()))
+
+    def close(self):
+        self.connection.close()
+
+
+class BatchSnapClean(SnapClean):
+    # Runs many tag/policy jobs against one region.  The region's owned, completed
+    # snapshots carrying any of the jobs' tag keys are listed once, grouped client side
+    # by (tagKey, tagValue), and each job's policy is applied to its group using a single
+    # AMI index.  API calls therefore scale with regions rather than jobs.
+    def __init__(self,
+                 region,
+                 jobs,
+                 batchName,
+                 snapCleanFactory,
+                 account,
+                 logLevel,
+                 dryRunFlag,
+                 **engineArgs):
+
+        SnapClean.__init__(self, region, 0, 0, 0, None, batchName, account, logLevel, dryRunFlag, **engineArgs)
+
+        self.jobs = []
+        for job in jobs:
+            jobSnapClean = snapCleanFactory(region, job['tagKey'], job['tagValue'], job['policy'])
+            # Jobs share the region's pooled clients, rate limiter and run metrics
+            jobSnapClean.throttle = self.throttle
+            jobSnapClean.metrics = self.metrics
+            jobSnapClean.exportMetrics = False
+            self.jobs.append(jobSnapClean)
+
+    @staticmethod
+    def loadJobFile(path):
+        # JSON, or YAML when PyYAML is installed:
+        #   {"jobs": [{"tagKey": "MakeSnapshot", "tagValue": "DevTest14", "policy": "14:0:0"}, ...]}
+        with open(path) as jobFile:
+            if path.endswith(('.yml', '.yaml')):
+                import yaml
+                document = yaml.safe_load(jobFile)
+            else:
+                document = json.load(jobFile)
+
+        jobs = document.get('jobs', []) if isinstance(document, dict) else document
+        if not jobs:
+            raise ValueError('Job file %s contains no jobs' % path)
+        for job in jobs:
+            for field in ('tagKey', 'tagValue', 'policy'):
+                if field not in job:
+                    raise ValueError('Job %s in %s is missing %s' % (job, path, field))
+            SnapClean.parsePolicy(str(job['policy']))
+            job['policy'] = str(job['policy'])
+        return jobs
+
+    def snsInit(self):
+        SnapClean.snsInit(self)
+        for job in self.jobs:
+            job.sns = self.sns
+
+    def tagFilter(self):
+        return {
+            'Name': 'tag-key',
+            'Values': sorted(set(job.tagKey for job in self.jobs))
+        }
+
+    def recordTagKeys(self):
+        return frozenset(job.tagKey for job in self.jobs).union(*[job.groupTagKeys() for job in self.jobs])
+
+    # A snapshot tagged for several jobs is listed by each of their partitions
+    PARTITIONS_OVERLAP = True
+
+    def listingPartitions(self, baseFilter):
+        # One slice per job tag value instead of the batch's tag-key filter
+        tags = sorted(set((job.tagKey, job.tagValue) for job in self.jobs))
+        return [('%s=%s' % (tagKey, tagValue), baseFilter + [{'Name': 'tag:' + tagKey, 'Values': [tagValue]}])
+                for tagKey, tagValue in tags]
+
+    def groupSnapshots(self, snapshot_iterator):
+        tagKeys = set(job.tagKey for job in self.jobs)
+        groups = {}
+        for snapshot in snapshot_iterator:
+            for tag in (snapshot.tags or []):
+                if tag['Key'] in tagKeys:
+                    groups.setdefault((tag['Key'], tag['Value']), []).append(snapshot)
+        return groups
+
+    def leaseName(self):
+        return '%s/%s/batch=%s%s' % (self.account, self.region, self.tagValue, self.shardSuffix())
+
+    def executeJob(self, snapshot_iterator=None, in_use_snapshots=None):
+        startTime = datetime.now().replace(microsecond=0)
+
+        self.logger.info('============================================================================')
+        self.logger.info('Batch of %s jobs in region %s', len(self.jobs), self.region)
+
+        if (self.resumeFlag is True or self.applyPlan is True):
+            # Each job resumes its own journal or applies its own plan, no listing needed
+            combined = {}
+            for job in self.jobs:
+                for key, value in job.execute().items():
+                    combined[key] = combined.get(key, 0) + value
+            self.writeMetrics(combined)
+            return combined
+
+        with self.metrics.phase('listing'):
+            groups = self.groupSnapshots(self.shardFilter(self.getFilteredSnapshots()))
+        self.logger.info('Listed %s snapshots across %s tag groups', sum(len(group) for group in groups.values()), len(groups))
+
+        with self.metrics.phase('amiScan'):
+            in_use_snapshots = self.getInUseSnapshots()
+
+        combined = {}
+        for job in self.jobs:
+            self.logger.info('Job %s=%s with policy %s:%s:%s', job.tagKey, job.tagValue, job.policyDay, job.policyWeek, job.policyMonth)
+            results = job.execute(iter(groups.get((job.tagKey, job.tagValue), [])), in_use_snapshots)
+            for key, value in results.items():
+                combined[key] = combined.get(key, 0) + value
+
+        # Every job saw the same AMI index, don't count it once per job
+        combined[SnapClean.TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS] = len(in_use_snapshots)
+
+        finishTime = datetime.now().replace(microsecond=0)
+
+        self.logger.info('============================================================================')
+        self.logger.info('Total Snapshots inspected %s', combined.get(SnapClean.TOTAL_SNAPSHOTS_FOUND, 0))
+        self.logger.info('Expired Snapshots %s', combined.get(SnapClean.EXPIRED_SNAPSHOTS_FOUND, 0))
+        self.logger.info('Deleted Snapshots %s', combined.get(SnapClean.SNAPSHOTS_DELETED, 0))
+        self.logger.info('Exceptions Encountered %s', combined.get(SnapClean.EXCEPTIONS_ENCOUNTERED, 0))
+        self.logger.info('Verdicts reused %s, recomputed %s', combined.get(SnapClean.VERDICTS_REUSED, 0), combined.get(SnapClean.VERDICTS_RECOMPUTED, 0))
+        self.logger.info('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+        self.logger.info('++ Completed processing for batch in ' + str(finishTime - startTime) + ' seconds')
+        self.logger.info('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+
+        self.writeMetrics(combined)
+        return combined
+
+
+class TokenBucket(object):
+    # Thread safe token bucket: tokens refill at `rate` per second up to `burst`.
+    # A rate of 0 or less disables limiting.
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                waitSeconds = (1 - self.tokens) / self.rate
+            time.sleep(waitSeconds)
+
+
+class AdaptiveRateLimiter(TokenBucket):
+    # AIMD controller on top of the token bucket.  Throttling errors from the EC2 API
+    # cut the rate multiplicatively, and each successful call adds back a little, up to
+    # maxRate.  Retries after a throttle sleep for a randomly jittered, exponentially
+    # growing interval so concurrent jobs don't retry in lockstep.
+    THROTTLE_ERROR_CODES = frozenset([
+        'RequestLimitExceeded',
+        'Throttling',
+        'ThrottlingException',
+        'ThrottledException',
+        'RequestThrottled',
+        'RequestThrottledException',
+        'TooManyRequestsException',
+        'SlowDown',
+    ])
+
+    def __init__(self, rate, burst, maxRate=None, minRate=0.5, increaseStep=0.05,
+                 decreaseFactor=0.5, attempts=5, sleeptime=1.0, maxSleeptime=60.0, logger=None):
+        TokenBucket.__init__(self, rate, burst)
+        self.maxRate = float(maxRate) if maxRate else self.rate
+        self.minRate = min(minRate, self.rate) if self.rate > 0 else minRate
+        self.increaseStep = increaseStep
+        self.decreaseFactor = decreaseFactor
+        self.attempts = attempts
+        self.sleeptime = sleeptime
+        self.maxSleeptime = maxSleeptime
+        self.logger = logger
+        self.throttleEvents = 0
+        self.retries = 0
+        self.lastDecrease = 0.0
+
+    @staticmethod
+    def errorCode(e):
+        return e.response.get('Error', {}).get('Code', '')
+
+    def isThrottle(self, e):
+        return isinstance(e, ClientError) and AdaptiveRateLimiter.errorCode(e) in AdaptiveRateLimiter.THROTTLE_ERROR_CODES
+
+    def currentRate(self):
+        with self.lock:
+            return round(self.rate, 2)
+
+    def resetCounters(self):
+        # Counters start again for each run of a long lived limiter; the rate carries over
+        with self.lock:
+            self.throttleEvents = 0
+            self.retries = 0
+
+    def onSuccess(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.increaseStep)
+
+    def onThrottle(self):
+        with self.lock:
+            self.throttleEvents += 1
+            if self.rate <= 0:
+                return
+            # A burst of concurrent failures is one congestion signal, so only cut once per second
+            now = time.monotonic()
+            if now - self.lastDecrease < 1.0:
+                return
+            self.lastDecrease = now
+            self.rate = max(self.minRate, self.rate * self.decreaseFactor)
+            self.tokens = 0.0
+            newRate = self.rate
+        if self.logger:
+            self.logger.warning('API throttling detected, reducing request rate to %.2f requests/sec', newRate)
+
+    def onError(self, e):
+        if self.isThrottle(e):
+            self.onThrottle()
+
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self.maxSleeptime, self.sleeptime * (2 ** attempt))))
+
+    def call(self, func, *args, **kwargs):
+        # Invoke an API call under the rate limit, retrying only throttling errors
+        for attempt in range(1, self.attempts + 1):
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except ClientError as e:
+                if not self.isThrottle(e):
+                    raise
+                self.onThrottle()
+                if attempt == self.attempts:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                self.backoff(attempt)
+                continue
+            self.onSuccess()
+            return result
+
+
+class DeletionEngine(object):
+    # Deletes expired snapshots from a thread pool.  The DeleteSnapshot calls are paced
+    # by the SnapClean instance's shared rate limiter instead of sleeping every N deletes.
+    # At most queueSize deletes are pending at once, so a lazily produced stream of
+    # snapshots is consumed no faster than it can be deleted.
+    # With a journal, each snapshot is journaled before its delete is queued (unless the
+    # whole plan was journaled up front) and checkpointed once it is gone.
+    def __init__(self, snapClean, concurrency, queueSize, journal=None):
+        self.snapClean = snapClean
+        self.concurrency = max(1, concurrency)
+        self.journal = journal
+        self.resultsLock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(self.concurrency, queueSize))
+
+    def worker(self, idx, snapshot, results):
+        try:
+            if self.snapClean.processExpiredSnapshot(idx, snapshot, results, self.resultsLock) and self.journal is not None:
+                self.journal.checkpoint(snapshot.snapshot_id)
+        finally:
+            self.slots.release()
+
+    def run(self, snapshots, results):
+        # Only pending futures are kept, so memory is bounded by the queue rather than the run
+        pending = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for idx, snapshot in enumerate(snapshots, 1):
+                if self.snapClean.shouldStop():
+                    break
+                if self.journal is not None and not self.journal.planComplete:
+                    self.journal.plan(snapshot)
+                self.slots.acquire()
+                pending.add(executor.submit(self.worker, idx, snapshot, results))
+                self.snapClean.metrics.gauge('deletionQueue', len(pending))
+                done = [future for future in pending if future.done()]
+                for future in done:
+                    pending.discard(future)
+                    future.result()
+            for future in pending:
+                future.result()
+
+
+class PlanFile(object):
+    # The expired snapshots of a run, for review before --apply-plan: JSON lines, or CSV
+    # with a header row.  Each row carries the policy hash of the job that made it.
+    FORMATS = ('jsonl', 'csv')
+    FIELDS = ('snapshotId', 'volumeId', 'startTime', 'reason', 'policyHash')
+
+    def __init__(self, path, planFormat, policyHash):
+        self.path = path
+        self.planFormat = planFormat
+        self.policyHash = policyHash
+        self.file = open(path, 'w', newline='')
+        if planFormat == 'csv':
+            self.csvWriter = csv.writer(self.file)
+            self.csvWriter.writerow(PlanFile.FIELDS)
+
+    def write(self, snapshot, reason):
+        row = (snapshot.snapshot_id, snapshot.volume_id or '', snapshot.start_time.isoformat(), reason, self.policyHash)
+        if self.planFormat == 'csv':
+            self.csvWriter.writerow(row)
+        else:
+            self.file.write(json.dumps(dict(zip(PlanFile.FIELDS, row))) + '\n')
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def load(path):
+        return list(PlanFile.rows(path))
+
+    @staticmethod
+    def rows(path, fields=None):
+        # Dicts, or tuples of just `fields`, which is far cheaper for large CSV files
+        with open(path, newline='') as planFile:
+            if path.endswith('.csv'):
+                if fields is None:
+                    for row in csv.DictReader(planFile):
+                        yield row
+                    return
+                reader = csv.reader(planFile)
+                header = next(reader)
+                columns = [header.index(field) for field in fields]
+                for row in reader:
+                    yield tuple([row[column] for column in columns])
+            else:
+                for line in planFile:
+                    if line.strip():
+                        row = json.loads(line)
+                        yield row if fields is None else tuple([row[field] for field in fields])
+
+
+class DeletionJournal(object):
+    # Append-only JSON lines file: a 'plan' entry per snapshot to delete, written before
+    # its delete is attempted, 'planned' once the plan is complete, a 'done' checkpoint per
+    # snapshot confirmed gone, and 'complete' when the run finished without failures.
+    SYNC_EVERY = 100
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.unsynced = 0
+        self.planComplete = resume
+        self.file = open(path, 'a' if resume else 'w')
+        if not resume:
+            self.write({'op': 'start', 'time': datetime.now(timezone.utc).isoformat()})
+
+    def write(self, entry, sync=False):
+        with self.lock:
+            self.file.write(json.dumps(entry) + '\n')
+            self.file.flush()
+            self.unsynced += 1
+            if sync or self.unsynced >= DeletionJournal.SYNC_EVERY:
+                os.fsync(self.file.fileno())
+                self.unsynced = 0
+
+    def plan(self, snapshot):
+        self.write({
+            'op': 'plan',
+            'id': snapshot.snapshot_id,
+            'volume': getattr(snapshot, 'volume_id', None),
+            'start': snapshot.start_time.isoformat()
+        })
+
+    def planAll(self, snapshots):
+        for snapshot in snapshots:
+            self.plan(snapshot)
+        self.write({'op': 'planned'}, sync=True)
+        self.planComplete = True
+
+    def checkpoint(self, snapshotId):
+        self.write({'op': 'done', 'id': snapshotId})
+
+    def close(self, complete):
+        if not self.planComplete:
+            self.write({'op': 'planned'})
+        if complete:
+            self.write({'op': 'complete'})
+        with self.lock:
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    @staticmethod
+    def load(path):
+        # Returns (SnapshotRecords still to delete, whether the plan was complete), or
+        # (None, False) when there is no journal or its run completed
+        if not os.path.exists(path):
+            return None, False
+        planned = {}
+        done = set()
+        planComplete = False
+        with open(path) as journalFile:
+            for line in journalFile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    continue
+                if entry['op'] == 'plan':
+                    planned[entry['id']] = entry
+                elif entry['op'] == 'done':
+                    done.add(entry['id'])
+                elif entry['op'] == 'planned':
+                    planComplete = True
+                elif entry['op'] == 'complete':
+                    return None, False
+        remaining = []
+        for snapshotId, entry in planned.items():
+            if snapshotId not in done:
+                startTime = datetime.strptime(entry['start'][:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+                remaining.append(SnapshotRecord(snapshotId, startTime, entry.get('volume'), None))
+        return remaining, planComplete
+
+
+class ListingCheckpoint(object):
+    # JSON lines file of an in-progress snapshot listing: a 'start' entry carrying a hash
+    # of the listing's filters, then a 'page' entry per page with its snapshots, compacted
+    # to the fields SnapshotRecords keep, and the NextToken that follows it.  Each page is
+    # synced before it is handed on, and the file is removed once the listing completes.
+    def __init__(self, path, listingHash, tagKeys):
+        self.path = path
+        self.listingHash = listingHash
+        self.tagKeys = tagKeys
+        self.file = None
+
+    def resume(self, ttl):
+        # Returns (NextToken, pages of snapshot dicts) of a matching listing started less
+        # than ttl seconds ago, or (None, []) to list from the start
+        if not os.path.exists(self.path):
+            return None, []
+        nextToken = None
+        pages = []
+        with open(self.path) as checkpointFile:
+            for line in checkpointFile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write
+                    break
+                if entry['op'] == 'start':
+                    if entry['hash'] != self.listingHash or time.time() - entry['time'] > ttl:
+                        return None, []
+                elif entry['op'] == 'page':
+                    pages.append([ListingCheckpoint.expand(snapshot) for snapshot in entry['snapshots']])
+                    nextToken = entry['next']
+        if not nextToken:
+            return None, []
+        self.file = open(self.path, 'a')
+        return nextToken, pages
+
+    def start(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'w')
+        self.write({'op': 'start', 'hash': self.listingHash, 'time': time.time()})
+
+    def page(self, snapshots, nextToken):
+        self.write({'op': 'page', 'snapshots': [self.compact(snapshot) for snapshot in snapshots], 'next': nextToken})
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def complete(self):
+        self.file.close()
+        os.remove(self.path)
+
+    def compact(self, snapshot):
+        return [snapshot['SnapshotId'], snapshot['StartTime'].isoformat(), snapshot.get('VolumeId'), snapshot.get('VolumeSize'),
+                [tag for tag in snapshot.get('Tags', []) if tag['Key'] in self.tagKeys]]
+
+    @staticmethod
+    def expand(entry):
+        snapshotId, startTime, volumeId, volumeSize, tags = entry
+        startTime = datetime.strptime(startTime[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+        return {'SnapshotId': snapshotId, 'StartTime': startTime, 'VolumeId': volumeId, 'VolumeSize': volumeSize, 'Tags': tags}
+
+
+class RegionFanOut(object):
+    # Runs one SnapClean per region concurrently within a single process.  Every region
+    # keeps its own rate limiter, log file and results dict; the per-region results are
+    # combined into one summary at the end.
+    def __init__(self, regions, snapCleanFactory, concurrency, runName):
+        self.regions = regions
+        self.snapCleanFactory = snapCleanFactory
+        self.concurrency = max(1, concurrency)
+        self.runName = runName
+        self.logger = RegionFanOut.summaryLogger(runName)
+
+    @staticmethod
+    def summaryLogger(runName):
+        logger = logging.getLogger('SnapClean.summary.' + runName)
+        logger.propagate = False
+        if not logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(
+                filename='summary_' + runName + '_SnapClean.log',
+                mode='a',
+                maxBytes=512 * 1024,
+                backupCount=10)
+            handler.setFormatter(logging.Formatter('[%(asctime)s][%(levelname)s]%(message)s'))
+            logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        return logger
+
+    @staticmethod
+    def resolveRegions(regionArg):
+        # Accept a single region, a comma separated list, or 'all' enabled regions
+        if regionArg.strip().lower() == 'all':
+            return RegionFanOut.describeRegions()
+        return [region.strip() for region in regionArg.split(',') if region.strip()]
+
+    @staticmethod
+    @retriable(attempts=5, sleeptime=5, jitter=2)
+    def describeRegions():
+        # Outside any job's rate limiter, and the pooled EC2 client makes a single attempt
+        ec2 = ClientPool.client('ec2', ClientPool.session().region_name or 'us-east-1')
+        return sorted(region['RegionName'] for region in ec2.describe_regions()['Regions'])
+
+    def runRegion(self, region):
+        snapClean = self.snapCleanFactory(region)
+        snapClean.snsInit()
+        return snapClean.execute()
+
+    def collect(self, label=''):
+        # Returns the results of each region that completed, and the regions that failed
+        regionResults = {}
+        failedRegions = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = dict((executor.submit(self.runRegion, region), region) for region in self.regions)
+            for future in concurrent.futures.as_completed(futures):
+                region = futures[future]
+                try:
+                    regionResults[region] = future.result()
+                except Exception as e:
+                    self.logger.error('Exception processing region %s%s, %s', label, region, str(e))
+                    failedRegions.append(region)
+        return regionResults, failedRegions
+
+    @staticmethod
+    def combine(unitResults):
+        combined = {}
+        for results in unitResults.values():
+            for key, value in results.items():
+                combined[key] = combined.get(key, 0) + value
+        return combined
+
+    def logUnit(self, kind, unit, results):
+        self.logger.info('%s %s : inspected %s, expired %s, deleted %s, exceptions %s',
+                         kind,
+                         unit,
+                         results.get(SnapClean.TOTAL_SNAPSHOTS_FOUND, 0),
+                         results.get(SnapClean.EXPIRED_SNAPSHOTS_FOUND, 0),
+                         results.get(SnapClean.SNAPSHOTS_DELETED, 0),
+                         results.get(SnapClean.EXCEPTIONS_ENCOUNTERED, 0))
+
+    def logTotals(self, combined, startTime, scope):
+        finishTime = datetime.now().replace(microsecond=0)
+        self.logger.info('Total Snapshots inspected %s', combined.get(SnapClean.TOTAL_SNAPSHOTS_FOUND, 0))
+        self.logger.info('Expired Snapshots %s', combined.get(SnapClean.EXPIRED_SNAPSHOTS_FOUND, 0))
+        self.logger.info('Deleted Snapshots %s', combined.get(SnapClean.SNAPSHOTS_DELETED, 0))
+        self.logger.info('Total Snapshots in use with AMIs : %s', combined.get(SnapClean.TOTAL_SNAPSHOTS_ASSOCIATED_WITH_AMIS, 0))
+        self.logger.info('Total In-scope Snapshots currently in use with an AMI : %s', combined.get(SnapClean.TOTAL_INSCOPE_SNAPSHOTS_ASSOCIATED_WITH_AMIS, 0))
+        self.logger.info('Exceptions Encountered %s', combined.get(SnapClean.EXCEPTIONS_ENCOUNTERED, 0))
+        self.logger.info('Verdicts reused %s, recomputed %s', combined.get(SnapClean.VERDICTS_REUSED, 0), combined.get(SnapClean.VERDICTS_RECOMPUTED, 0))
+        self.logger.info('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+        self.logger.info('++ Completed processing for all ' + scope + ' in ' + str(finishTime - startTime) + ' seconds')
+        self.logger.info('++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++')
+
+    def run(self):
+        startTime = datetime.now().replace(microsecond=0)
+
+        regionResults, failedRegions = self.collect()
+        combined = RegionFanOut.combine(regionResults)
+
+        self.logger.info('============================================================================')
+        for region in sorted(regionResults):
+            self.logUnit('Region', region, regionResults[region])
+        for region in sorted(failedRegions):
+            self.logger.error('Region %s : FAILED', region)
+        self.logger.info('============================================================================')
+        self.logger.info('Regions processed %s of %s', len(regionResults), len(self.regions))
+        self.logTotals(combined, startTime, 'regions')
+
+        return combined
+
+
+class AccountFanOut(RegionFanOut):
+    # Runs the same job in every listed account, on an assumed role in each.  A bounded
+    # pool works through the accounts; within an account the regions fan out as usual.
+    # Every (account, region) SnapClean has its own rate limiter, which is the scope EC2
+    # throttles at, and the results of all of them are merged into one run summary.
+    def __init__(self, accounts, regions, snapCleanFactory, accountConcurrency, regionConcurrency, runName,
+                 roleName, externalId=None):
+        RegionFanOut.__init__(self, regions, snapCleanFactory, regionConcurrency, runName)
+        self.accounts = accounts
+        self.accountConcurrency = max(1, accountConcurrency)
+        self.roleName = roleName
+        self.externalId = externalId
+
+    @staticmethod
+    def resolveAccounts(accountsArg):
+        # A comma separated list, or @<file> with one account per line ('#' starts a comment)
+        if accountsArg.startswith('@'):
+            with open(accountsArg[1:]) as accountsFile:
+                accountsArg = ','.join(line.split('#')[0] for line in accountsFile)
+        return [account.strip() for account in accountsArg.split(',') if account.strip()]
+
+    def runAccount(self, account):
+        # Assume the role up front, so an account it fails in is reported once, not per region
+        AssumedRoleCredentials.forAccount(account, self.roleName, self.externalId).get_frozen_credentials()
+        regionFanOut = RegionFanOut(self.regions, lambda region: self.snapCleanFactory(account, region),
+                                    self.concurrency, self.runName)
+        return regionFanOut.collect('%s/' % account)
+
+    def run(self):
+        startTime = datetime.now().replace(microsecond=0)
+
+        accountResults = {}
+        failedAccounts = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.accountConcurrency) as executor:
+            futures = dict((executor.submit(self.runAccount, account), account) for account in self.accounts)
+            for future in concurrent.futures.as_completed(futures):
+                account = futures[future]
+                try:
+                    accountResults[account] = future.result()
+                except Exception as e:
+                    # Typically the role could not be assumed in this account
+                    self.logger.error('Exception processing account %s, %s', account, str(e))
+                    failedAccounts.append(account)
+
+        unitResults = {}
+        self.logger.info('============================================================================')
+        for account in sorted(accountResults):
+            regionResults, failedRegions = accountResults[account]
+            for region in sorted(regionResults):
+                unitResults[(account, region)] = regionResults[region]
+                self.logUnit('Account', '%s region %s' % (account, region), regionResults[region])
+            for region in sorted(failedRegions):
+                self.logger.error('Account %s region %s : FAILED', account, region)
+        for account in sorted(failedAccounts):
+            self.logger.error('Account %s : FAILED', account)
+        self.logger.info('============================================================================')
+        for account in sorted(accountResults):
+            self.logUnit('Account', account, RegionFanOut.combine(accountResults[account][0]))
+        self.logger.info('============================================================================')
+        self.logger.info('Accounts processed %s of %s', len(accountResults), len(self.accounts))
+        self.logger.info('Account regions processed %s of %s', len(unitResults), len(self.accounts) * len(self.regions))
+        combined = RegionFanOut.combine(unitResults)
+        self.logTotals(combined, startTime, 'accounts')
+
+        return combined
+
+
+class AssumedRoleCredentials(object):
+    # STS credentials for a role in each account, assumed once with the ambient credentials
+    # and shared by every region and job in that account for the life of the process.
+    # botocore refreshes them in place shortly before they expire, so long runs and warm
+    # Lambda containers never call AWS with expired credentials.
+    SESSION_NAME = 'SnapClean'
+
+    cache = {}
+    cacheLock = threading.Lock()
+
+    @staticmethod
+    def roleArn(account, roleName):
+        if roleName.startswith('arn:'):
+            return roleName.replace('{account}', account)
+        return 'arn:aws:iam::%s:role/%s' % (account, roleName)
+
+    @classmethod
+    def forAccount(cls, account, roleName, externalId=None):
+        key = (account, roleName, externalId)
+        # Taken before cacheLock, as the pool may call in here while holding its own lock
+        stsClient = ClientPool.client('sts')
+        with cls.cacheLock:
+            if key not in cls.cache:
+                from botocore.credentials import DeferredRefreshableCredentials
+                assumeRoleArgs = {'RoleArn': cls.roleArn(account, roleName), 'RoleSessionName': cls.SESSION_NAME}
+                if externalId:
+                    assumeRoleArgs['ExternalId'] = externalId
+
+                def refresh():
+                    credentials = stsClient.assume_role(**assumeRoleArgs)['Credentials']
+                    return {
+                        'access_key': credentials['AccessKeyId'],
+                        'secret_key': credentials['SecretAccessKey'],
+                        'token': credentials['SessionToken'],
+                        'expiry_time': credentials['Expiration'].isoformat()
+                    }
+
+                cls.cache[key] = DeferredRefreshableCredentials(refresh_using=refresh, method='assume-role')
+            return cls.cache[key]
+
+    @classmethod
+    def session(cls, account, roleName, externalId=None):
+        # A new boto3 session on the account's shared credentials
+        import boto3
+        import botocore.session
+        botocoreSession = botocore.session.get_session()
+        botocoreSession._credentials = cls.forAccount(account, roleName, externalId)
+        return boto3.session.Session(botocore_session=botocoreSession)
+
+
+class ClientPool(object):
+    # Process wide boto3 sessions, one per account (None for the ambient credentials), and
+    # clients keyed by (account, region, service).  Credentials and endpoints are resolved
+    # once, and every thread and retry reuses the client's pool of keep-alive connections.
+    # A client is rebuilt with a bigger pool if a caller needs more connections than it
+    # has.  Clients report API call latencies to the RunMetrics of every live caller.
+    DEFAULT_CONNECTIONS = 10
+    RETRY_MODES = ('standard', 'adaptive')
+    RATE_LIMITED_SERVICES = frozenset(['ec2'])
+
+    retryMode = 'standard'
+    sessions = {}
+    clients = {}
+    observers = {}
+    # Re-entrant, as assuming a role for a new session needs the STS client
+    lock = threading.RLock()
+
+    @classmethod
+    def session(cls, account=None, roleName=None, externalId=None):
+        with cls.lock:
+            if account not in cls.sessions:
+                if account is None:
+                    import boto3
+                    cls.sessions[account] = boto3.session.Session()
+                else:
+                    cls.sessions[account] = AssumedRoleCredentials.session(account, roleName, externalId)
+            return cls.sessions[account]
+
+    @classmethod
+    def config(cls, service, connections):
+        # EC2 calls are paced and retried by the job's AdaptiveRateLimiter, which has to see
+        # every throttle; botocore retrying them too would multiply the load while the API
+        # is throttling, and an adaptive mode bucket would fight the limiter.  So EC2
+        # clients make one attempt, and retryMode only covers the other services.
+        from botocore.config import Config
+        if service in ClientPool.RATE_LIMITED_SERVICES:
+            retries = {'mode': 'standard', 'total_max_attempts': 1}
+        else:
+            retries = {'mode': cls.retryMode}
+        return Config(max_pool_connections=connections, tcp_keepalive=True, retries=retries)
+
+    @classmethod
+    def client(cls, service, region=None, account=None, roleName=None, externalId=None,
+               connections=DEFAULT_CONNECTIONS, metrics=None, resource=False):
+        key = (account, region, service)
+        connections = max(connections, ClientPool.DEFAULT_CONNECTIONS)
+        with cls.lock:
+            observers = cls.observers.setdefault(key, weakref.WeakSet())
+            if metrics is not None:
+                observers.add(metrics)
+            pooled = cls.clients.get(key)
+            if pooled is None or pooled['connections'] < connections:
+                # Handlers registered on the session before now, eg. by tests, are copied in
+                session = cls.session(account, roleName, externalId)
+                client = session.client(service, region_name=region, config=cls.config(service, connections))
+                cls.instrument(client, observers)
+                pooled = cls.clients[key] = {'client': client, 'connections': connections, 'resource': None}
+            if not resource:
+                return pooled['client']
+            if pooled['resource'] is None:
+                # Building a resource makes a client of its own; swap in the pooled one
+                pooledResource = cls.session(account, roleName, externalId).resource(service, region_name=region)
+                pooledResource.meta.client = pooled['client']
+                pooled['resource'] = pooledResource
+            return pooled['resource']
+
+    @staticmethod
+    def instrument(client, observers):
+        # The clock starts at parameter build, which is emitted for every call, even stubbed ones
+        def afterCall(model, context, http_response, **kwargs):
+            ClientPool.observe(observers, model.name, context, http_response.status_code >= 300)
+
+        def afterCallError(context, **kwargs):
+            # Connection level failures have no response, only the context from startCall
+            ClientPool.observe(observers, context.get('snapCleanOperation'), context, True)
+
+        client.meta.events.register('before-parameter-build', RunMetrics.startCall)
+        client.meta.events.register('after-call', afterCall)
+        client.meta.events.register('after-call-error', afterCallError)
+
+    @staticmethod
+    def observe(observers, operation, context, error):
+        start = context.pop('snapCleanStart', None)
+        if start is None:
+            return
+        seconds = time.perf_counter() - start
+        for metrics in list(observers):
+            metrics.observeCall(operation, seconds, error)
+
+
+class LeaseLock(object):
+    # A named lease with an expiry, so overlapping runs of the same job don't both delete.
+    # The holder renews it every ttl/3 seconds from a background thread; should a renewal
+    # fail, `lost` is set and the deletion engine stops queueing deletes.  A holder that
+    # dies simply lets the lease expire.  Backends only need tryAcquire(name, owner,
+    # expires, now), which takes or extends the lease if it is free, expired or already
+    # theirs, holder(name) and release(name, owner).
+    BACKENDS = {}
+
+    def __init__(self, backend, name, ttl, logger=None):
+        self.backend = backend
+        self.name = name
+        self.ttl = ttl
+        self.logger = logger
+        self.owner = '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lost = False
+        self.holder = None
+        self.stopped = threading.Event()
+        self.renewer = None
+
+    @staticmethod
+    def fromSpec(spec, name, ttl, logger=None):
+        # 'sqlite:<path>', 'dynamodb:<table>', or a bare path for SQLite
+        kind, sep, target = spec.partition(':')
+        if not sep or kind not in LeaseLock.BACKENDS:
+            kind, target = 'sqlite', spec
+        return LeaseLock(LeaseLock.BACKENDS[kind](target), name, ttl, logger)
+
+    def acquire(self):
+        now = time.time()
+        if not self.backend.tryAcquire(self.name, self.owner, now + self.ttl, now):
+            self.holder = self.backend.holder(self.name)
+            return False
+        self.renewer = threading.Thread(target=self.renewLoop, name='LeaseRenewer')
+        self.renewer.daemon = True
+        self.renewer.start()
+        return True
+
+    def renewLoop(self):
+        while not self.stopped.wait(self.ttl / 3.0):
+            now = time.time()
+            try:
+                renewed = self.backend.tryAcquire(self.name, self.owner, now + self.ttl, now)
+            except Exception as e:
+                renewed = False
+                if self.logger:
+                    self.logger.error('Exception renewing lease %s, %s', self.name, str(e))
+            if not renewed:
+                self.lost = True
+                return
+
+    def release(self):
+        self.stopped.set()
+        if self.renewer is not None:
+            self.renewer.join()
+        if not self.lost:
+            self.backend.release(self.name, self.owner)
+
+
+class SqliteLeaseBackend(object):
+    # Leases in a local SQLite file, for workers on one host or a shared filesystem
+    def __init__(self, path):
+        self.path = path
+        connection = self.connect()
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT, expires REAL)')
+        connection.close()
+
+    def connect(self):
+        # A connection per call, as the renewer runs on its own thread
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def tryAcquire(self, name, owner, expires, now):
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            row = connection.execute('SELECT owner, expires FROM leases WHERE name = ?', (name,)).fetchone()
+            if row is not None and row[0] != owner and row[1] > now:
+                connection.execute('ROLLBACK')
+                return False
+            connection.execute('INSERT OR REPLACE INTO leases VALUES (?, ?, ?)', (name, owner, expires))
+            connection.execute('COMMIT')
+            return True
+        finally:
+            connection.close()
+
+    def holder(self, name):
+        connection = self.connect()
+        try:
+            row = connection.execute('SELECT owner FROM leases WHERE name = ?', (name,)).fetchone()
+            return row[0] if row else None
+        finally:
+            connection.close()
+
+    def release(self, name, owner):
+        connection = self.connect()
+        try:
+            connection.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+        finally:
+            connection.close()
+
+
+class DynamoDbLeaseBackend(object):
+    # Leases in a DynamoDB table with a string partition key `name`, for workers on
+    # different hosts.  Taking the lease is a single conditional put.
+    def __init__(self, table):
+        self.table = table
+        self.client = ClientPool.client('dynamodb')
+
+    def tryAcquire(self, name, owner, expires, now):
+        try:
+            self.client.put_item(
+                TableName=self.table,
+                Item={'name': {'S': name}, 'owner': {'S': owner}, 'expires': {'N': repr(expires)}},
+                ConditionExpression='attribute_not_exists(#name) OR #owner = :owner OR #expires < :now',
+                ExpressionAttributeNames={'#name': 'name', '#owner': 'owner', '#expires': 'expires'},
+                ExpressionAttributeValues={':owner': {'S': owner}, ':now': {'N': repr(now)}})
+            return True
+        except ClientError as e:
+            if AdaptiveRateLimiter.errorCode(e) == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+    def holder(self, name):
+        item = self.client.get_item(TableName=self.table, Key={'name': {'S': name}}).get('Item')
+        return item['owner']['S'] if item else None
+
+    def release(self, name, owner):
+        try:
+            self.client.delete_item(TableName=self.table, Key={'name': {'S': name}},
+                                    ConditionExpression='#owner = :owner',
+                                    ExpressionAttributeNames={'#owner': 'owner'},
+                                    ExpressionAttributeValues={':owner': {'S': owner}})
+        except ClientError as e:
+            if AdaptiveRateLimiter.errorCode(e) != 'ConditionalCheckFailedException':
+                raise
+
+
+LeaseLock.BACKENDS.update({'sqlite': SqliteLeaseBackend, 'dynamodb': DynamoDbLeaseBackend})
+
+
+class RunMetrics(object):
+    # Instrumentation for one run: exclusive wall time per phase (time spent in a nested
+    # phase, such as listing pulled through classification, counts only towards the inner
+    # one), per-operation API call counts and latency histograms collected from botocore
+    # call events, event counters and high-water marks of queue depths.
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = {}
+            self.api = {}
+            self.events = {}
+            self.gauges = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        frame = [name, time.perf_counter(), 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            if stack:
+                stack[-1][2] += elapsed
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed - frame[2]
+
+    def timedIterator(self, name, iterable):
+        # Attribute the time spent producing each item of a lazy iterator to a phase
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def phaseSeconds(self):
+        with self.lock:
+            return dict((name, round(seconds, 3)) for name, seconds in sorted(self.phases.items()))
+
+    @staticmethod
+    def startCall(model, context, **kwargs):
+        # Registered on every pooled client, see ClientPool.instrument
+        context['snapCleanOperation'] = model.name
+        context['snapCleanStart'] = time.perf_counter()
+
+    def observeCall(self, operation, seconds, error):
+        with self.lock:
+            stats = self.api.get(operation)
+            if stats is None:
+                stats = self.api[operation] = {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                               'buckets': [0] * (len(RunMetrics.LATENCY_BUCKETS) + 1)}
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            for i, bound in enumerate(RunMetrics.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    break
+            else:
+                i = len(RunMetrics.LATENCY_BUCKETS)
+            stats['buckets'][i] += 1
+
+    def event(self, name, count=1):
+        with self.lock:
+            self.events[name] = self.events.get(name, 0) + count
+
+    def gauge(self, name, value):
+        # Keeps the last and the highest value seen
+        with self.lock:
+            last, peak = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(peak, value))
+
+    def report(self, labels, results):
+        with self.lock:
+            api = {}
+            for operation, stats in sorted(self.api.items()):
+                cumulative = list(itertools.accumulate(stats['buckets']))
+                api[operation] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'seconds': round(stats['seconds'], 3),
+                    'latencyBuckets': dict(zip([str(bound) for bound in RunMetrics.LATENCY_BUCKETS] + ['+Inf'], cumulative))
+                }
+            return {
+                'labels': labels,
+                'time': datetime.now(timezone.utc).isoformat(),
+                'results': results,
+                'phases': dict((name, round(seconds, 3)) for name, seconds in sorted(self.phases.items())),
+                'api': api,
+                'events': dict(sorted(self.events.items())),
+                'gauges': dict((name, {'last': last, 'max': peak}) for name, (last, peak) in sorted(self.gauges.items()))
+            }
+
+    @staticmethod
+    def writeAtomically(path, text):
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'w') as reportFile:
+            reportFile.write(text)
+        os.replace(tmpPath, path)
+
+    def writeReport(self, path, labels, results):
+        RunMetrics.writeAtomically(path, json.dumps(self.report(labels, results), indent=2) + '\n')
+
+    def writePrometheus(self, path, labels, results):
+        # Prometheus text exposition format, for node_exporter's textfile collector
+        report = self.report(labels, results)
+
+        def series(name, value, **extra):
+            allLabels = dict(labels, **extra)
+            return '%s{%s} %s' % (name, ','.join('%s="%s"' % (key, str(val).replace('"', '\\"')) for key, val in sorted(allLabels.items())), value)
+
+        lines = ['# TYPE snapclean_snapshots gauge']
+        lines += [series('snapclean_snapshots', value, result=key) for key, value in sorted(results.items())]
+        lines.append('# TYPE snapclean_phase_seconds gauge')
+        lines += [series('snapclean_phase_seconds', seconds, phase=name) for name, seconds in report['phases'].items()]
+        lines.append('# TYPE snapclean_api_errors_total counter')
+        lines += [series('snapclean_api_errors_total', stats['errors'], operation=operation) for operation, stats in report['api'].items()]
+        lines.append('# TYPE snapclean_api_latency_seconds histogram')
+        for operation, stats in report['api'].items():
+            lines += [series('snapclean_api_latency_seconds_bucket', count, operation=operation, le=bound)
+                      for bound, count in stats['latencyBuckets'].items()]
+            lines.append(series('snapclean_api_latency_seconds_sum', stats['seconds'], operation=operation))
+            lines.append(series('snapclean_api_latency_seconds_count', stats['count'], operation=operation))
+        lines.append('# TYPE snapclean_events_total counter')
+        lines += [series('snapclean_events_total', count, event=name) for name, count in report['events'].items()]
+        lines.append('# TYPE snapclean_gauge_max gauge')
+        lines += [series('snapclean_gauge_max', values['max'], gauge=name) for name, values in report['gauges'].items()]
+        lines.append('# TYPE snapclean_last_run_timestamp_seconds gauge')
+        lines.append(series('snapclean_last_run_timestamp_seconds', int(time.time())))
+        RunMetrics.writeAtomically(path, '\n'.join(lines) + '\n')
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() formats the message on the calling thread.  Records are only
+    # read back by the QueueListener in this process, so pass them through unformatted and
+    # let the listener thread do the % formatting and file I/O.
+    def prepare(self, record):
+        if record.exc_info:
+            return logging.handlers.QueueHandler.prepare(self, record)
+        return record
+
+
+class LogQueue(object):
+    # With --log-queue every logger writes through a QueueHandler, and a QueueListener
+    # thread per logger owns the file handler.  Listeners are stopped, draining their
+    # queue, at interpreter exit.
+    listeners = {}
+    lock = threading.Lock()
+
+    @staticmethod
+    def attach(logger, handler, queued):
+        with LogQueue.lock:
+            listener = LogQueue.listeners.pop(logger.name, None)
+            if listener is not None:
+                listener.stop()
+            for existing in list(logger.handlers):
+                logger.removeHandler(existing)
+                existing.close()
+            if listener is not None:
+                for existing in listener.handlers:
+                    existing.close()
+
+            if not queued:
+                logger.addHandler(handler)
+                return
+
+            records = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(records, handler)
+            listener.start()
+            LogQueue.listeners[logger.name] = listener
+            logger.addHandler(DeferredQueueHandler(records))
+
+    @staticmethod
+    def stopAll():
+        with LogQueue.lock:
+            for listener in LogQueue.listeners.values():
+                listener.stop()
+                for handler in listener.handlers:
+                    handler.close()
+            LogQueue.listeners.clear()
+
+
+atexit.register(LogQueue.stopAll)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    # Formats a dict logged as the message as one JSON object per line
+    def format(self, record):
+        return json.dumps(record.msg, default=JsonLinesFormatter.encode, separators=(',', ':'))
+
+    @staticmethod
+    def encode(value):
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return str(value)
+
+
+class SnsNotifier(object):
+    # Publishes to the SnapClean topic through a client and topic ARN created once.
+    # Per-snapshot failures are buffered with notifyEvent() and published as a digest by
+    # a background thread once digestEvents are waiting or the oldest is digestSeconds
+    # old, and by flush() at the end of a run, so the deletion threads never wait on SNS.
+    SAMPLE_IDS = 10
+
+    def __init__(self, topic, context='', digestEvents=500, digestSeconds=300, logger=None):
+        self.topic = topic
+        self.logger = logger
+        self.context = context
+        self.digestEvents = digestEvents
+        self.digestSeconds = digestSeconds
+        self.client = None
+        self.topicArn = None
+        self.clientLock = threading.Lock()
+        self.events = []
+        self.oldestEvent = None
+        self.condition = threading.Condition()
+        self.flusher = None
+        self.stopping = False
+        self.metrics = None
+
+    def getTopicArn(self):
+        with self.clientLock:
+            if self.topicArn is None:
+                self.client = ClientPool.client('sns', metrics=self.metrics)
+                self.topicArn = self.client.create_topic(Name=self.topic)['TopicArn']
+            return self.topicArn
+
+    @retriable(attempts=5, sleeptime=10, jitter=5)
+    def sendSns(self, subject, message):
+        try:
+            topicArn = self.getTopicArn()
+            # SNS rejects subjects over 100 characters
+            self.client.publish(TopicArn=topicArn, Subject=subject[:100], Message=str(message))
+        except Exception:
+            # Each failed attempt is retried by redo until the attempts run out
+            if self.metrics is not None:
+                self.metrics.event('snsPublishFailure')
+            raise
+
+    def notifyEvent(self, errorCode, snapshotId, message):
+        with self.condition:
+            self.events.append((errorCode, snapshotId, message))
+            if self.metrics is not None:
+                self.metrics.gauge('snsDigestBuffer', len(self.events))
+            if self.oldestEvent is None:
+                self.oldestEvent = time.monotonic()
+            if self.flusher is None:
+                self.stopping = False
+                self.flusher = threading.Thread(target=self.flushLoop, name='SnsDigest')
+                self.flusher.daemon = True
+                self.flusher.start()
+            self.condition.notify()
+
+    def takeEvents(self):
+        events = self.events
+        self.events = []
+        self.oldestEvent = None
+        return events
+
+    def flushLoop(self):
+        while True:
+            with self.condition:
+                while not self.stopping and len(self.events) < self.digestEvents and \
+                        (self.oldestEvent is None or time.monotonic() - self.oldestEvent < self.digestSeconds):
+                    timeout = None if self.oldestEvent is None else self.digestSeconds - (time.monotonic() - self.oldestEvent)
+                    self.condition.wait(timeout)
+                if self.stopping:
+                    return
+                events = self.takeEvents()
+            self.sendDigest(events)
+
+    def sendDigest(self, events):
+        if not events:
+            return
+        byCode = {}
+        for errorCode, snapshotId, message in events:
+            byCode.setdefault(errorCode, []).append((snapshotId, message))
+
+        lines = ['%s snapshot delete failures (%s)' % (len(events), self.context), '']
+        for errorCode, failures in sorted(byCode.items(), key=lambda item: -len(item[1])):
+            lines.append('%s: %s' % (errorCode, len(failures)))
+            lines.append('  e.g. %s' % failures[0][1])
+            lines.append('  snapshots: %s%s' % (', '.join(snapshotId for snapshotId, message in failures[:SnsNotifier.SAMPLE_IDS]),
+                                                 ' ...' if len(failures) > SnsNotifier.SAMPLE_IDS else ''))
+
+        snsSubject = 'SnapClean.py : %s snapshot delete failures %s' % (len(events), self.context)
+        try:
+            self.sendSns(snsSubject, '\n'.join(lines))
+        except Exception as e:
+            if self.logger:
+                self.logger.error('Exception sending SNS digest, %s', str(e))
+
+    def flush(self):
+        # Stop the background flusher and publish whatever is still buffered
+        with self.condition:
+            flusher = self.flusher
+            self.stopping = True
+            self.condition.notify()
+        if flusher is not None:
+            flusher.join()
+        with self.condition:
+            self.flusher = None
+            events = self.takeEvents()
+        self.sendDigest(events)
+
+
+class LambdaContinuation(object):
+    # The continuation token of an invocation that ran out of time is its deletion journal:
+    # uploaded to S3 when a continuationBucket is given, otherwise left in the working
+    # directory, which only survives into warm invocations of the same container.
+    @staticmethod
+    def save(snapClean, event):
+        path = snapClean.journalPath()
+        token = {'journal': path}
+        bucket = event.get('continuationBucket')
+        if bucket:
+            key = event.get('continuationPrefix', 'snapclean/') + os.path.basename(path)
+            lambdaClient(snapClean, 's3').upload_file(path, bucket, key)
+            token.update({'bucket': bucket, 'key': key})
+        return token
+
+    @staticmethod
+    def restore(snapClean, token):
+        if token.get('bucket'):
+            lambdaClient(snapClean, 's3').download_file(token['bucket'], token['key'], snapClean.journalPath())
+        elif not os.path.exists(snapClean.journalPath()):
+            raise ValueError('Continuation journal %s is not in this container, set continuationBucket to carry it between invocations' % token['journal'])
+
+
+# SnapClean instances kept across warm invocations of the Lambda function; their clients
+# stay in the ClientPool
+lambdaJobs = {}
+# Event keys that don't change the SnapClean instance, so are left out of its cache key
+LAMBDA_PER_INVOCATION_KEYS = frozenset(['continuation', 'workDir'])
+
+
+def lambdaClient(snapClean, service):
+    return ClientPool.client(service, snapClean.region)
+
+
+def lambda_handler(event, context):
+    # AWS Lambda entry point.  The event carries the same settings as the command line:
+    #   {"region": "us-east-1", "policy": "7:5:12", "tagKey": "MakeSnapshot", "tagValue": "DevTest14",
+    #    "account": "123456789101", "dryRun": false, "continuationBucket": "my-bucket"}
+    # Deletes stop being queued once fewer than reserveSeconds remain.  The response then
+    # holds a continuation token; invoking again with it as "continuation" resumes the
+    # deletes without relisting.  With "selfInvoke" the function does so itself.
+    os.chdir(event.get('workDir', '/tmp'))
+    region = event.get('region') or os.environ['AWS_REGION']
+    # Every setting the instance is built from is part of the key, so a warm container never
+    # runs a job under another event's retention group, lock or listing settings
+    key = (region, json.dumps(dict((name, value) for name, value in event.items() if name not in LAMBDA_PER_INVOCATION_KEYS),
+                              sort_keys=True, default=str))
+
+    snapClean = lambdaJobs.get(key)
+    if snapClean is None:
+        ClientPool.retryMode = event.get('retryMode', ClientPool.retryMode)
+        policyDay, policyWeek, policyMonth = SnapClean.parsePolicy(event['policy'])
+        snapClean = SnapClean(region, policyDay, policyWeek, policyMonth, event['tagKey'], event['tagValue'],
+                              event['account'], event.get('logLevel', 'info'), bool(event.get('dryRun', False)),
+                              concurrency=event.get('concurrency', SnapClean.DEFAULT_CONCURRENCY),
+                              rate=event.get('rate', SnapClean.DEFAULT_RATE),
+                              burst=event.get('burst', SnapClean.DEFAULT_BURST),
+                              maxRate=event.get('maxRate'),
+                              fastListing=event.get('fastListing', True),
+                              amiCacheDir=event.get('amiCacheDir'),
+                              amiCacheTtl=event.get('amiCacheTtl', SnapClean.DEFAULT_AMI_CACHE_TTL),
+                              shard=SnapClean.parseShard(event['shard']) if event.get('shard') else None,
+                              shardBy=event.get('shardBy', 'volume'),
+                              lockSpec=event.get('lock'),
+                              lockTtl=event.get('lockTtl', SnapClean.DEFAULT_LOCK_TTL),
+                              retentionGroup=event.get('retentionGroup'),
+                              listConcurrency=event.get('listConcurrency', 0))
+        # Also log to CloudWatch
+        snapClean.logger.addHandler(logging.StreamHandler(sys.stdout))
+        snapClean.snsInit()
+        lambdaJobs[key] = snapClean
+    else:
+        snapClean.resetMetrics()
+
+    # The whole plan is journaled before deleting, so an interruption loses nothing
+    snapClean.streamFlag = False
+    snapClean.remainingTime = lambda: context.get_remaining_time_in_millis() / 1000.0
+    snapClean.reserveSeconds = event.get('reserveSeconds', SnapClean.DEFAULT_LAMBDA_RESERVE_SECONDS)
+    snapClean.interrupted = False
+
+    continuation = event.get('continuation')
+    snapClean.resumeFlag = continuation is not None
+    if continuation is not None:
+        LambdaContinuation.restore(snapClean, continuation)
+
+    results = snapClean.execute()
+    if not snapClean.interrupted:
+        return {'complete': True, 'results': results, 'continuation': None}
+    if snapClean.dryRunFlag is True:
+        # A dry run keeps no journal to continue from, so its report stops where the time ran out
+        return {'complete': False, 'results': results, 'continuation': None,
+                'reason': 'Dry run stopped at the time budget; dry runs keep no journal, so cannot be continued'}
+
+    token = LambdaContinuation.save(snapClean, event)
+    if event.get('selfInvoke'):
+        lambdaClient(snapClean, 'lambda').invoke(FunctionName=context.invoked_function_arn, InvocationType='Event',
+                                                 Payload=json.dumps(dict(event, continuation=token)))
+    return {'complete': False, 'results': results, 'continuation': token}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Command line parser')
+    parser.add_argument('-r', '--region',
+                        help='AWS Region indicator. A comma separated list, or all, processes several regions concurrently',
+                        required=True)
+    parser.add_argument('-p', '--policy',
+                        help='Retention period for the snapshots. Retention based on the following notation Day:Week:Month eg. 7:5:12 would retain 7 daily, 5 weekly and 12 monthly',
+                        required=False)
+    parser.add_argument('-k', '--tagKey',
+                        help='The name of the Tag Key used for snapshot searches',
+                        required=False)
+    parser.add_argument('-v', '--tagValue',
+                        help='The Tag Value used to match snapshot searches',
+                        required=False)
+    parser.add_argument('-j', '--jobFile',
+                        help='JSON or YAML file listing tagKey/tagValue/policy jobs that share one snapshot listing per region. Replaces -p, -k and -v',
+                        required=False)
+    parser.add_argument('-a', '--account',
+                        help='AWS account number',
+                        required=False)
+    parser.add_argument('-d', '--dryrun', action='count',
+                        help='Run but take no Action',
+                        required=False)
+    parser.add_argument('-l', '--loglevel',
+                        choices=[
+                            'critical',
+                            'error',
+                            'warning',
+                            'info',
+                            'debug',
+                            'notset'
+                            ],
+                        help='The level to record log messages to the logfile',
+                        required=False)
+    parser.add_argument('-c', '--concurrency', type=int, default=SnapClean.DEFAULT_CONCURRENCY,
+                        help='Number of snapshot deletes to run in parallel',
+                        required=False)
+    parser.add_argument('--rate', type=float, default=SnapClean.DEFAULT_RATE,
+                        help='Initial EC2 API requests per second, lowered automatically on throttling. 0 for unlimited',
+                        required=False)
+    parser.add_argument('--max-rate', type=float, dest='maxRate',
+                        help='Ceiling the request rate may ramp up to while calls succeed. Defaults to --rate',
+                        required=False)
+    parser.add_argument('--burst', type=int, default=SnapClean.DEFAULT_BURST,
+                        help='Number of EC2 API requests allowed to exceed the rate in a burst',
+                        required=False)
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='Delete expired snapshots while the listing is still in progress, bounding memory by the queue size',
+                        required=False)
+    parser.add_argument('--queue-size', type=int, dest='queueSize', default=SnapClean.DEFAULT_QUEUE_SIZE,
+                        help='Maximum number of expired snapshots waiting to be deleted',
+                        required=False)
+    parser.add_argument('--state-db', dest='stateDb',
+                        help='SQLite file recording verdicts between runs, so unchanged snapshots are not re-classified',
+                        required=False)
+    parser.add_argument('--resume', action='store_true',
+                        help='Finish the deletions journaled by an interrupted run instead of listing snapshots again',
+                        required=False)
+    parser.add_argument('--ami-cache', dest='amiCacheDir',
+                        help='Directory to persist the AMI to snapshot index in, refreshed incrementally once older than --ami-cache-ttl',
+                        required=False)
+    parser.add_argument('--ami-cache-ttl', type=int, dest='amiCacheTtl', default=SnapClean.DEFAULT_AMI_CACHE_TTL,
+                        help='Seconds a persisted AMI index is used before it is refreshed',
+                        required=False)
+    parser.add_argument('--sns-digest-events', type=int, dest='digestEvents', default=SnapClean.DEFAULT_DIGEST_EVENTS,
+                        help='Publish the SNS digest of delete failures early once this many are waiting',
+                        required=False)
+    parser.add_argument('--sns-digest-seconds', type=int, dest='digestSeconds', default=SnapClean.DEFAULT_DIGEST_SECONDS,
+                        help='Publish the SNS digest of delete failures early once the oldest is this many seconds old',
+                        required=False)
+    parser.add_argument('--log-queue', action='store_true', dest='logQueue', default=False,
+                        help='Format and write log records on a background thread instead of the deletion threads',
+                        required=False)
+    parser.add_argument('--log-max-bytes', type=int, dest='logMaxBytes', default=SnapClean.DEFAULT_LOG_MAX_BYTES,
+                        help='Rotate the log file once it reaches this size',
+                        required=False)
+    parser.add_argument('--log-backups', type=int, dest='logBackups', default=SnapClean.DEFAULT_LOG_BACKUPS,
+                        help='Number of rotated log files to keep',
+                        required=False)
+    parser.add_argument('--decisions', action='store_true', dest='decisionsFlag', default=False,
+                        help='Also write every per-snapshot decision to <region>_<TagValue>_SnapClean.decisions.jsonl',
+                        required=False)
+    parser.add_argument('--metrics', action='store_true', dest='metricsFlag', default=False,
+                        help='Write phase timings, API call latencies and queue depths to <region>_<TagValue>_SnapClean.metrics.json',
+                        required=False)
+    parser.add_argument('--prometheus-dir', dest='prometheusDir', default=None,
+                        help='Also write the run metrics as a Prometheus textfile to this directory',
+                        required=False)
+    parser.add_argument('--shard', dest='shard', default=None,
+                        help='Only handle shard i of N (0 <= i < N), e.g. 0/4 .. 3/4 on four workers',
+                        required=False)
+    parser.add_argument('--shard-by', dest='shardBy', choices=['volume', 'snapshot'], default='volume',
+                        help='Shard by a stable hash of the volume id (default) or of the snapshot id',
+                        required=False)
+    parser.add_argument('--lock', dest='lockSpec', default=None,
+                        help='Hold a lease per job so overlapping runs skip it: a SQLite file path, sqlite:<path> or dynamodb:<table>',
+                        required=False)
+    parser.add_argument('--lock-ttl', type=int, dest='lockTtl', default=SnapClean.DEFAULT_LOCK_TTL,
+                        help='Seconds before an unrenewed lease expires',
+                        required=False)
+    parser.add_argument('--retention-group', dest='retentionGroup', default=None,
+                        help='Apply the policy to each volume (volume) or each value of a tag (tag:<Key>) separately, keeping the newest snapshot per day/week/month',
+                        required=False)
+    parser.add_argument('--write-plan', dest='planFormat', choices=PlanFile.FORMATS, default=None,
+                        help='Write the expired snapshots to <region>_<TagValue>_SnapClean.plan.<jsonl|csv>, e.g. with -d for review',
+                        required=False)
+    parser.add_argument('--apply-plan', action='store_true', dest='applyPlan', default=False,
+                        help='Delete exactly the snapshots in the plan written by --write-plan, without listing snapshots again',
+                        required=False)
+    parser.add_argument('--simulate', type=int, dest='simulateDays', default=None,
+                        help='Delete nothing; simulate how many snapshots expire on each of the next SIMULATEDAYS days',
+                        required=False)
+    parser.add_argument('--simulate-policies', dest='simulatePolicies', default=None,
+                        help='Comma separated Day:Week:Month policies to simulate, e.g. 7:5:12,14:4:24. Defaults to -p',
+                        required=False)
+    parser.add_argument('--inventory', dest='inventory', default=None,
+                        help='Simulate over this plan or inventory file (.jsonl or .csv) instead of listing snapshots',
+                        required=False)
+    parser.add_argument('--list-concurrency', type=int, dest='listConcurrency', default=0,
+                        help='List snapshots in partitions, this many at a time: by volume id prefix, or by job tag with -j',
+                        required=False)
+    parser.add_argument('--listing-checkpoint', action='store_true', dest='listingCheckpoint', default=False,
+                        help='Persist each listed page and its NextToken, so a run interrupted mid-listing resumes from there. Requires -f',
+                        required=False)
+    parser.add_argument('-f', '--fast-listing', action='store_true', dest='fastListing',
+                        help='List snapshots with the low level DescribeSnapshots paginator into compact records, using far less memory for large accounts',
+                        required=False)
+    parser.add_argument('--region-concurrency', type=int, dest='regionConcurrency',
+                        help='Number of regions to process in parallel. Defaults to all of them',
+                        required=False)
+    parser.add_argument('--accounts', dest='accounts', default=None,
+                        help='Run in each of these accounts instead of -a: a comma separated list, or @<file> with one per line. Requires --assume-role',
+                        required=False)
+    parser.add_argument('--assume-role', dest='assumeRole', default=None,
+                        help='Name (or ARN, with {account} for the account number) of the role to assume in each account',
+                        required=False)
+    parser.add_argument('--external-id', dest='externalId', default=None,
+                        help='External id to pass when assuming --assume-role',
+                        required=False)
+    parser.add_argument('--account-concurrency', type=int, dest='accountConcurrency', default=4,
+                        help='Number of accounts to process in parallel',
+                        required=False)
+    parser.add_argument('--retry-mode', dest='retryMode', choices=ClientPool.RETRY_MODES, default=ClientPool.retryMode,
+                        help='botocore retry mode of the SNS, STS, S3, DynamoDB and Lambda clients; EC2 calls are paced and retried by the --rate limiter alone',
+                        required=False)
+
+    args = parser.parse_args()
+
+    if args.simulateDays is not None:
+        if args.jobFile or args.accounts:
+            parser.error('--simulate runs a single job, without -j/--jobFile or --accounts')
+        if args.inventory and args.retentionGroup and args.retentionGroup != 'volume':
+            parser.error('--inventory files carry no tags, so only --retention-group volume can be simulated from one')
+    elif args.inventory or args.simulatePolicies:
+        parser.error('--inventory and --simulate-policies require --simulate')
+
+    if args.listingCheckpoint and not args.fastListing:
+        parser.error('--listing-checkpoint requires -f/--fast-listing')
+
+    if not args.account and not args.accounts:
+        parser.error('one of -a/--account or --accounts is required')
+
+    if args.accounts and not args.assumeRole:
+        parser.error('--accounts requires --assume-role')
+
+    if not args.jobFile and not (args.policy and args.tagKey and args.tagValue):
+        parser.error('-p/--policy, -k/--tagKey and -v/--tagValue are required unless -j/--jobFile is given')
+
+    if args.retentionGroup and args.retentionGroup != 'volume' and not (args.retentionGroup.startswith('tag:') and len(args.retentionGroup) > 4):
+        parser.error('--retention-group must be volume or tag:<Key>')
+
+    shard = None
+    if args.shard:
+        try:
+            shard = SnapClean.parseShard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+
+    # Log level
+    if args.loglevel:
+        loglevel = args.loglevel
+    else:
+        loglevel = 'info'
+
+    # Dryrun Flag
+    if args.dryrun:
+        dryRun = True
+    else:
+        dryRun = False
+
+    ClientPool.retryMode = args.retryMode
+
+    # Launch SnapClean
+    engineArgs = {
+        'concurrency': args.concurrency,
+        'rate': args.rate,
+        'burst': args.burst,
+        'maxRate': args.maxRate,
+        'streamFlag': args.stream,
+        'queueSize': args.queueSize,
+        'fastListing': args.fastListing,
+        'stateDb': args.stateDb,
+        'resumeFlag': args.resume,
+        'amiCacheDir': args.amiCacheDir,
+        'amiCacheTtl': args.amiCacheTtl,
+        'digestEvents': args.digestEvents,
+        'digestSeconds': args.digestSeconds,
+        'logQueue': args.logQueue,
+        'logMaxBytes': args.logMaxBytes,
+        'logBackups': args.logBackups,
+        'decisionsFlag': args.decisionsFlag,
+        'metricsFlag': args.metricsFlag,
+        'prometheusDir': args.prometheusDir,
+        'shard': shard,
+        'shardBy': args.shardBy,
+        'lockSpec': args.lockSpec,
+        'lockTtl': args.lockTtl,
+        'retentionGroup': args.retentionGroup,
+        'planFormat': args.planFormat,
+        'applyPlan': args.applyPlan,
+        'assumeRole': args.assumeRole,
+        'externalId': args.externalId,
+        'listingCheckpoint': args.listingCheckpoint,
+        'listConcurrency': args.listConcurrency
+    }
+
+    def accountJobFactory(account, region, tagKey, tagValue, policy):
+        policyDay, policyWeek, policyMonth = SnapClean.parsePolicy(policy)
+        return SnapClean(
+            region,
+            policyDay,
+            policyWeek,
+            policyMonth,
+            tagKey,
+            tagValue,
+            account,
+            loglevel,
+            dryRun,
+            **engineArgs
+            )
+
+    if args.jobFile:
+        jobs = BatchSnapClean.loadJobFile(args.jobFile)
+        runName = os.path.splitext(os.path.basename(args.jobFile))[0]
+
+        def accountSnapCleanFactory(account, region):
+            def jobFactory(region, tagKey, tagValue, policy):
+                return accountJobFactory(account, region, tagKey, tagValue, policy)
+            return BatchSnapClean(region, jobs, runName, jobFactory, account, loglevel, dryRun, **engineArgs)
+    else:
+        runName = args.tagValue
+
+        def accountSnapCleanFactory(account, region):
+            return accountJobFactory(account, region, args.tagKey, args.tagValue, args.policy)
+
+    def snapCleanFactory(region):
+        return accountSnapCleanFactory(args.account, region)
+
+    regions = RegionFanOut.resolveRegions(args.region)
+
+    if args.simulateDays is not None:
+        simulatePolicies = [policy.strip() for policy in (args.simulatePolicies or args.policy).split(',') if policy.strip()]
+        for region in regions:
+            snapCleanMain = snapCleanFactory(region)
+
+            snapCleanMain.snsInit()
+
+            snapCleanMain.simulate(args.simulateDays, simulatePolicies, args.inventory)
+    elif args.accounts:
+        fanOut = AccountFanOut(
+            AccountFanOut.resolveAccounts(args.accounts),
+            regions,
+            accountSnapCleanFactory,
+            args.accountConcurrency,
+            args.regionConcurrency or len(regions),
+            runName,
+            args.assumeRole,
+            args.externalId
+            )
+
+        fanOut.run()
+    elif len(regions) == 1:
+        snapCleanMain = snapCleanFactory(regions[0])
+
+        snapCleanMain.snsInit()
+
+        snapCleanMain.execute()
+    else:
+        fanOut = RegionFanOut(
+            regions,
+            snapCleanFactory,
+            args.regionConcurrency or len(regions),
+            runName
+            )
 
+        fanOut.run()
@@ -0,0 +1,548 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+
+def makeMappings(count):
+    # Build a synthetic set of AMI block device mappings, roughly four snapshots per AMI
+    mappings = []
+    for i in range(count):
+        mappings.append(('snap-%017x' % random.getrandbits(68), 'ami-%017x' % (i // 4)))
+    return mappings
+
+
+def benchInUseLookup(mappingCount, probeCount):
+    mappings = makeMappings(mappingCount)
+
+    # Half of the probes are in use with an AMI, half are not
+    probes = [random.choice(mappings)[0] for _ in range(probeCount // 2)]
+    probes += ['snap-%017x' % random.getrandbits(68) for _ in range(probeCount - len(probes))]
+
+    # Original behaviour: a list of ids, substring scanned through str() for every snapshot
+    inUseList = [snapshotId for snapshotId, amiId in mappings]
+    start = time.perf_counter()
+    legacyHits = 0
+    for snapshotId in probes:
+        if snapshotId in str(inUseList):
+            legacyHits += 1
+    legacySeconds = time.perf_counter() - start
+
+    # Current behaviour: a dict keyed by snapshot id, mapped to the AMI ids using it
+    start = time.perf_counter()
+    inUseIndex = {}
+    for snapshotId, amiId in mappings:
+        inUseIndex.setdefault(snapshotId, []).append(amiId)
+    buildSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexedHits = 0
+    for snapshotId in probes:
+        if snapshotId in inUseIndex:
+            indexedHits += 1
+    indexedSeconds = time.perf_counter() - start
+
+    assert legacyHits == indexedHits, 'legacy and indexed lookups disagree'
+
+    return {
+        'mappings': mappingCount,
+        'probes': probeCount,
+        'legacyPerLookupUs': legacySeconds / probeCount * 1e6,
+        'indexedPerLookupUs': indexedSeconds / probeCount * 1e6,
+        'indexBuildMs': buildSeconds * 1e3,
+        'speedup': legacySeconds / max(indexedSeconds, 1e-9),
+    }
+
+
+def runInUseLookup(args):
+    for mappingCount in args.mappings:
+        result = benchInUseLookup(mappingCount, args.probes)
+        print('%(mappings)9d mappings: legacy %(legacyPerLookupUs)12.1f us/lookup, '
+              'indexed %(indexedPerLookupUs)6.3f us/lookup, index build %(indexBuildMs)8.1f ms, '
+              'speedup %(speedup)12.0fx' % result)
+
+
+def makeDescribeSnapshotsItems(count):
+    # Items shaped like a DescribeSnapshots response, three years of history
+    now = datetime(2020, 1, 1)
+    items = []
+    for i in range(count):
+        items.append({
+            'SnapshotId': 'snap-%017x' % i,
+            'StartTime': now - timedelta(minutes=i * 3 * 365 * 24 * 60 // count),
+            'VolumeId': 'vol-%017x' % (i % 500),
+            'VolumeSize': 100,
+            'State': 'completed',
+            'Progress': '100%',
+            'OwnerId': '123456789101',
+            'Encrypted': False,
+            'Description': 'Created by CreateImage(i-0123456789abcdef0) for ami-0123456789abcdef0 from vol-0123456789abcdef0',
+            'Tags': [{'Key': 'MakeSnapshot', 'Value': 'DevTest14'}, {'Key': 'Name', 'Value': 'volume %d' % (i % 500)}],
+        })
+    return items
+
+
+def benchSnapshotRecords(count):
+    import boto3
+    from SnapClean3 import SnapshotRecord
+
+    items = makeDescribeSnapshotsItems(count)
+
+    # Resource path: every item wrapped in a boto3 Snapshot resource holding the full response
+    ec2 = boto3.session.Session().resource('ec2', region_name='us-east-1')
+    snapshotClass = type(ec2.Snapshot('snap-0'))
+    tracemalloc.start()
+    start = time.perf_counter()
+    resources = []
+    for item in items:
+        snapshot = snapshotClass(item['SnapshotId'], client=ec2.meta.client)
+        snapshot.meta.data = dict(item)
+        resources.append(snapshot)
+    resourceDates = [snapshot.start_time.date() for snapshot in resources]
+    resourceSeconds = time.perf_counter() - start
+    resourcePeak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del resources
+
+    # Fast path: compact __slots__ records
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = []
+    for item in items:
+        records.append(SnapshotRecord(item['SnapshotId'], item['StartTime'], item.get('VolumeId'), item.get('VolumeSize')))
+    recordDates = [record.start_time.date() for record in records]
+    recordSeconds = time.perf_counter() - start
+    recordPeak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert resourceDates == recordDates, 'resource and record dates disagree'
+
+    return {
+        'snapshots': count,
+        'resourceSeconds': resourceSeconds,
+        'resourceMb': resourcePeak / 1e6,
+        'recordSeconds': recordSeconds,
+        'recordMb': recordPeak / 1e6,
+    }
+
+
+def runSnapshotRecords(args):
+    for count in args.snapshots:
+        result = benchSnapshotRecords(count)
+        print('%(snapshots)9d snapshots: resources %(resourceSeconds)7.2f s %(resourceMb)9.1f MB, '
+              'records %(recordSeconds)7.2f s %(recordMb)9.1f MB' % result)
+
+
+def legacyInclusionDates(policyDay, policyWeek, policyMonth, today):
+    # The original generateInclusionDatesList: dates_to_keep over every day of the range
+    from grandfatherson import dates_to_keep, SATURDAY
+    from SnapClean3 import RetentionIndex
+
+    start = RetentionIndex.rangeStart(policyDay, policyWeek, policyMonth, today)
+    days = [start + timedelta(days=i) for i in range((today - start).days + 1)]
+    return sorted(dates_to_keep(days, days=policyDay, weeks=policyWeek, months=policyMonth,
+                                firstweekday=SATURDAY, now=today))
+
+
+def checkRetentionParity(policies, todays):
+    from SnapClean3 import RetentionIndex
+
+    checked = 0
+    for policyDay, policyWeek, policyMonth in policies:
+        for today in todays:
+            index = RetentionIndex(policyDay, policyWeek, policyMonth, today)
+            expected = legacyInclusionDates(policyDay, policyWeek, policyMonth, today)
+            assert index.retainedDates() == expected, \
+                'policy %s:%s:%s on %s disagrees with dates_to_keep' % (policyDay, policyWeek, policyMonth, today)
+
+            # Every day of the range, plus a margin either side, classifies the same way
+            probes = [index.startDate + timedelta(days=i) for i in range(-10, (today - index.startDate).days + 10)]
+            expectedSet = set(expected)
+            assert index.classify(probes) == [probe in expectedSet for probe in probes]
+            checked += 1
+    return checked
+
+
+def benchRetention(policy, lookups):
+    from SnapClean3 import RetentionIndex
+
+    policyDay, policyWeek, policyMonth = policy
+    today = datetime(2026, 10, 17).date()
+
+    start = time.perf_counter()
+    inclusionDatesList = legacyInclusionDates(policyDay, policyWeek, policyMonth, today)
+    legacyBuildSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = RetentionIndex(policyDay, policyWeek, policyMonth, today)
+    indexBuildSeconds = time.perf_counter() - start
+
+    probes = [today - timedelta(days=random.randrange(0, 4000)) for _ in range(lookups)]
+
+    start = time.perf_counter()
+    legacyVerdicts = [probe in inclusionDatesList for probe in probes]
+    legacyLookupSeconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexVerdicts = index.classify(probes)
+    indexLookupSeconds = time.perf_counter() - start
+
+    assert legacyVerdicts == indexVerdicts, 'list and index verdicts disagree'
+
+    return {
+        'policy': '%s:%s:%s' % policy,
+        'lookups': lookups,
+        'legacyBuildMs': legacyBuildSeconds * 1e3,
+        'indexBuildMs': indexBuildSeconds * 1e3,
+        'legacyLookupMs': legacyLookupSeconds * 1e3,
+        'indexLookupMs': indexLookupSeconds * 1e3,
+    }
+
+
+def runRetention(args):
+    policies = [(7, 5, 12), (14, 0, 0), (0, 4, 0), (30, 0, 0), (7, 4, 3), (1, 1, 1), (40, 5, 0), (0, 0, 36), (3650, 520, 120)]
+    todays = [datetime(2026, 1, 1).date() + timedelta(days=i) for i in range(0, 365, args.parityStep)]
+    checked = checkRetentionParity(policies, todays)
+    print('RetentionIndex matches dates_to_keep for %d policy/day combinations' % checked)
+
+    for policy in [(7, 5, 12), (3650, 520, 120)]:
+        result = benchRetention(policy, args.lookups)
+        print('%(policy)12s: build list %(legacyBuildMs)8.2f ms, index %(indexBuildMs)6.2f ms; '
+              '%(lookups)d lookups list %(legacyLookupMs)9.1f ms, index %(indexLookupMs)6.1f ms' % result)
+
+
+class FakeHttpResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeAws(object):
+    # Local stand-in for EC2 and SNS.  Registered on a session's before-call event, it
+    # answers every API call with a parsed response before any request is made, so the
+    # real boto3 clients, paginators and SnapClean's metrics hooks all run unchanged.
+    # The snapshot population is generated on demand from its index rather than held in
+    # memory, so it doesn't count towards the measured peak.  Throttling and delete
+    # failures are decided by a hash of the snapshot id and attempt, so API call counts
+    # are the same on every run.
+    VOLUMES = 500
+
+    def __init__(self, snapshots, years, amis, throttleRate, failureRate, latency):
+        self.snapshots = snapshots
+        self.amis = amis
+        self.throttleRate = throttleRate
+        self.failureRate = failureRate
+        self.latency = latency
+        # Fixed, with SnapClean pinned to the same date, so every run sees the same population
+        self.now = datetime(2026, 10, 17, 12, 0, 0)
+        self.step = timedelta(days=365 * years) / max(1, snapshots)
+        self.attempts = {}
+        self.published = 0
+        self.matching = {}
+        self.volumeIds = [FakeAws.volumeId(volume) for volume in range(FakeAws.VOLUMES)]
+
+    def attach(self, session):
+        session.events.register('before-call', self.handle)
+
+    @staticmethod
+    def injected(key, rate):
+        if rate <= 0:
+            return False
+        digest = hashlib.md5(key.encode()).digest()
+        return int.from_bytes(digest[:4], 'big') < rate * 2 ** 32
+
+    @staticmethod
+    def volumeId(volume):
+        # Like a real account: current ids are vol-0 and 16 random hex digits, with one
+        # legacy 8 digit id and copies from elsewhere, which carry vol-ffffffff
+        if volume == FakeAws.VOLUMES - 1:
+            return 'vol-ffffffff'
+        if volume == FakeAws.VOLUMES - 2:
+            return 'vol-1a2b3c4d'
+        return 'vol-0%016x' % (volume * 0x9E3779B97F4A7C15 % 2 ** 64)
+
+    def snapshot(self, i):
+        return {
+            'SnapshotId': 'snap-%017x' % i,
+            'StartTime': self.now - self.step * i,
+            'VolumeId': self.volumeIds[i % FakeAws.VOLUMES],
+            'VolumeSize': 100,
+            'State': 'completed',
+            'OwnerId': '123456789101',
+            'Tags': [{'Key': 'MakeSnapshot', 'Value': 'Bench'}],
+        }
+
+    def page(self, params, indices, item):
+        # Page through the generated items at `indices`, honouring MaxResults and NextToken
+        start = int(params.get('NextToken') or 0)
+        size = params.get('MaxResults') or 1000
+        end = min(len(indices), start + size)
+        page = [item(i) for i in indices[start:end]]
+        return page, (str(end) if end < len(indices) else None)
+
+    def snapshotIndices(self, body):
+        # All snapshots carry the bench tag; a volume-id filter of wildcard patterns, as
+        # partitioned listings use, selects the matching volumes
+        patterns = FakeAws.filterValues(body, 'volume-id')
+        tagValues = FakeAws.filterValues(body, 'tag:MakeSnapshot')
+        if tagValues is not None and 'Bench' not in tagValues:
+            return []
+        if patterns is None:
+            return range(self.snapshots)
+        key = tuple(sorted(patterns))
+        if key not in self.matching:
+            volumes = [volume for volume in range(FakeAws.VOLUMES)
+                       if any(fnmatch.fnmatchcase(self.volumeIds[volume], pattern) for pattern in patterns)]
+            self.matching[key] = sorted(i for volume in volumes for i in range(volume, self.snapshots, FakeAws.VOLUMES))
+        return self.matching[key]
+
+    @staticmethod
+    def filterValues(body, name):
+        # EC2 query serialization flattens Filters into Filter.N.Name / Filter.N.Value.M
+        for key, value in body.items():
+            if key.startswith('Filter.') and key.endswith('.Name') and value == name:
+                prefix = key[:-len('Name')] + 'Value.'
+                return set(v for k, v in body.items() if k.startswith(prefix))
+        return None
+
+    def image(self, i):
+        # One AMI in five uses one of the listed snapshots, the rest use snapshots from elsewhere
+        snapshotId = 'snap-%017x' % (i * 37 % self.snapshots) if i % 5 == 0 else 'snap-f%016x' % i
+        return {'ImageId': 'ami-%017x' % i, 'State': 'available',
+                'BlockDeviceMappings': [{'DeviceName': '/dev/xvda', 'Ebs': {'SnapshotId': snapshotId}}]}
+
+    def handle(self, model, params, context, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        body = params.get('body') or {}
+        if isinstance(body, bytes):
+            body = {}
+        operation = model.name
+        if operation == 'DescribeSnapshots':
+            snapshots, token = self.page(body, self.snapshotIndices(body), self.snapshot)
+            response = {'Snapshots': snapshots}
+        elif operation == 'DescribeImages':
+            snapshotIds = FakeAws.filterValues(body, 'block-device-mapping.snapshot-id')
+            if snapshotIds is not None:
+                images = [self.image(i) for i in range(self.amis)]
+                images = [image for image in images if image['BlockDeviceMappings'][0]['Ebs']['SnapshotId'] in snapshotIds]
+                token = None
+            else:
+                images, token = self.page(body, range(self.amis), self.image)
+            response = {'Images': images}
+        elif operation == 'DeleteSnapshot':
+            snapshotId = body['SnapshotId']
+            attempt = self.attempts.get(snapshotId, 0) + 1
+            self.attempts[snapshotId] = attempt
+            if FakeAws.injected('%s/%s' % (snapshotId, attempt), self.throttleRate):
+                return FakeHttpResponse(503), {'Error': {'Code': 'RequestLimitExceeded', 'Message': 'Request limit exceeded.'}}
+            if FakeAws.injected(snapshotId, self.failureRate):
+                return FakeHttpResponse(400), {'Error': {'Code': 'IncorrectState', 'Message': 'The snapshot is in use.'}}
+            return FakeHttpResponse(200), {}
+        elif operation == 'CreateTopic':
+            return FakeHttpResponse(200), {'TopicArn': 'arn:aws:sns:us-east-1:123456789101:SnapClean'}
+        elif operation == 'Publish':
+            self.published += 1
+            return FakeHttpResponse(200), {'MessageId': str(self.published)}
+        else:
+            raise NotImplementedError('FakeAws does not implement %s' % operation)
+        if token:
+            response['NextToken'] = token
+        return FakeHttpResponse(200), response
+
+
+def runScenario(scenario, resultQueue):
+    # Runs in a fresh process, so the peak RSS belongs to this scenario alone
+    import resource
+
+    os.environ.update({'AWS_ACCESS_KEY_ID': 'bench', 'AWS_SECRET_ACCESS_KEY': 'bench',
+                       'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_EC2_METADATA_DISABLED': 'true'})
+    workDir = tempfile.mkdtemp(prefix='snapclean-bench-')
+    os.chdir(workDir)
+    try:
+        from SnapClean3 import SnapClean
+
+        fakeAws = FakeAws(scenario['snapshots'], scenario['years'], scenario['amis'],
+                          scenario['throttleRate'], scenario['failureRate'], scenario['latencyMs'] / 1000.0)
+        policyDay, policyWeek, policyMonth = SnapClean.parsePolicy(scenario['policy'])
+        snapClean = SnapClean('us-east-1', policyDay, policyWeek, policyMonth, 'MakeSnapshot', 'Bench', '123456789101',
+                              'info', False, concurrency=scenario['concurrency'], rate=0,
+                              streamFlag=scenario['stream'], fastListing=True, logQueue=scenario['logQueue'],
+                              listConcurrency=scenario.get('listConcurrency', 0))
+        # Pooled clients are created lazily from this session, SNS's included
+        fakeAws.attach(snapClean.session)
+        # Classify as of the population's date, so the results and API calls match the
+        # baseline whatever day the bench runs on
+        snapClean.pinnedDate = fakeAws.now.date()
+        snapClean.snsInit()
+        # Scaled down so injected throttling costs API calls rather than wall time
+        snapClean.throttle.sleeptime = 0.001
+
+        start = time.perf_counter()
+        results = snapClean.execute()
+        seconds = time.perf_counter() - start
+
+        report = snapClean.metrics.report({}, results)
+        resultQueue.put({
+            'seconds': round(seconds, 2),
+            'maxRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+            'phases': report['phases'],
+            'apiCalls': dict((operation, stats['count']) for operation, stats in report['api'].items()),
+            'results': results,
+        })
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'SnapCleanBench.baseline.json')
+
+SCENARIOS = {
+    # 100k snapshots over 3 years against 10k AMIs, 1% of deletes throttled
+    'production': {'snapshots': 100000, 'years': 3, 'amis': 10000, 'throttleRate': 0.01, 'failureRate': 0.001,
+                   'latencyMs': 0, 'policy': '7:5:12', 'concurrency': 4, 'stream': False, 'logQueue': False},
+    'production-stream': {'snapshots': 100000, 'years': 3, 'amis': 10000, 'throttleRate': 0.01, 'failureRate': 0.001,
+                          'latencyMs': 0, 'policy': '7:5:12', 'concurrency': 4, 'stream': True, 'logQueue': True},
+    'small': {'snapshots': 10000, 'years': 3, 'amis': 1000, 'throttleRate': 0.05, 'failureRate': 0.001,
+              'latencyMs': 0, 'policy': '14:0:0', 'concurrency': 4, 'stream': False, 'logQueue': False},
+}
+
+
+def measureScenario(scenario):
+    context = multiprocessing.get_context('spawn')
+    resultQueue = context.Queue()
+    process = context.Process(target=runScenario, args=(scenario, resultQueue))
+    process.start()
+    result = resultQueue.get()
+    process.join()
+    return result
+
+
+def compareToBaseline(name, result, baseline, tolerance, memoryTolerance):
+    # Wall time and memory may grow by the tolerance factors; API calls may not grow at all
+    regressions = []
+    if result['seconds'] > baseline['seconds'] * tolerance:
+        regressions.append('runtime %.2fs vs baseline %.2fs' % (result['seconds'], baseline['seconds']))
+    for phase, seconds in baseline['phases'].items():
+        if seconds >= 0.5 and result['phases'].get(phase, 0) > seconds * tolerance:
+            regressions.append('%s phase %.2fs vs baseline %.2fs' % (phase, result['phases'][phase], seconds))
+    if result['maxRssMb'] > baseline['maxRssMb'] * memoryTolerance:
+        regressions.append('peak memory %.1f MB vs baseline %.1f MB' % (result['maxRssMb'], baseline['maxRssMb']))
+    for operation, count in sorted(result['apiCalls'].items()):
+        if count > baseline['apiCalls'].get(operation, 0):
+            regressions.append('%s calls %d vs baseline %d' % (operation, count, baseline['apiCalls'].get(operation, 0)))
+    return ['%s: %s' % (name, regression) for regression in regressions]
+
+
+def runScenarios(args):
+    scenarios = dict(SCENARIOS)
+    if args.snapshots is not None:
+        # An ad hoc population, never compared against the baseline
+        scenarios = {'custom': dict(SCENARIOS['production'], snapshots=args.snapshots, amis=args.amis, years=args.years,
+                                    throttleRate=args.throttleRate, latencyMs=args.latencyMs, stream=args.stream,
+                                    concurrency=args.concurrency, policy=args.policy, listConcurrency=args.listConcurrency)}
+    names = args.scenarios or sorted(scenarios)
+
+    baselines = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as baselineFile:
+            baselines = json.load(baselineFile)
+
+    measured = {}
+    regressions = []
+    for name in names:
+        result = measureScenario(scenarios[name])
+        measured[name] = result
+        print('%-18s %7.2f s %8.1f MB  phases %s' % (name, result['seconds'], result['maxRssMb'],
+                                                     ', '.join('%s %.2f' % item for item in sorted(result['phases'].items()))))
+        print('%-18s api calls %s' % ('', ', '.join('%s %d' % item for item in sorted(result['apiCalls'].items()))))
+        if args.check and name in baselines:
+            regressions += compareToBaseline(name, result, baselines[name], args.tolerance, args.memoryTolerance)
+
+    if args.updateBaseline:
+        baselines.update(measured)
+        with open(BASELINE_PATH, 'w') as baselineFile:
+            json.dump(baselines, baselineFile, indent=2, sort_keys=True)
+            baselineFile.write('\n')
+        print('Baseline written to %s' % BASELINE_PATH)
+
+    if regressions:
+        for regression in regressions:
+            print('REGRESSION %s' % regression)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='SnapClean micro-benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    inUseParser = subparsers.add_parser('inuse',
+                                        help='In-use AMI snapshot lookup: str() substring scan vs dict index')
+    inUseParser.add_argument('--mappings', type=int, nargs='+', default=[10000, 100000, 1000000],
+                             help='AMI block device mapping counts to benchmark')
+    inUseParser.add_argument('--probes', type=int, default=20,
+                             help='Number of snapshot lookups per mapping count')
+    inUseParser.set_defaults(func=runInUseLookup)
+
+    recordsParser = subparsers.add_parser('records',
+                                          help='Snapshot listing: boto3 Snapshot resources vs compact SnapshotRecords')
+    recordsParser.add_argument('--snapshots', type=int, nargs='+', default=[10000, 100000],
+                               help='Snapshot counts to benchmark')
+    recordsParser.set_defaults(func=runSnapshotRecords)
+
+    retentionParser = subparsers.add_parser('retention',
+                                            help='Retention policy: dates_to_keep list membership vs RetentionIndex, with a parity check')
+    retentionParser.add_argument('--lookups', type=int, default=100000,
+                                 help='Number of snapshot start dates to classify')
+    retentionParser.add_argument('--parity-step', type=int, dest='parityStep', default=7,
+                                 help='Check parity for every Nth day of a year')
+    retentionParser.set_defaults(func=runRetention)
+
+    runParser = subparsers.add_parser('run',
+                                      help='Run SnapClean end to end against a local fake EC2 and SNS, optionally checked against the baseline')
+    runParser.add_argument('--scenario', dest='scenarios', nargs='+', choices=sorted(SCENARIOS),
+                           help='Scenarios to run, all by default')
+    runParser.add_argument('--check', action='store_true',
+                           help='Exit non-zero when a scenario regresses against SnapCleanBench.baseline.json')
+    runParser.add_argument('--update-baseline', dest='updateBaseline', action='store_true',
+                           help='Record the measured numbers as the new baseline')
+    runParser.add_argument('--tolerance', type=float, default=1.5,
+                           help='Allowed runtime growth factor over the baseline')
+    runParser.add_argument('--memory-tolerance', dest='memoryTolerance', type=float, default=1.25,
+                           help='Allowed peak memory growth factor over the baseline')
+    runParser.add_argument('--snapshots', type=int, default=None,
+                           help='Run one custom population of this many snapshots instead of the scenarios')
+    runParser.add_argument('--amis', type=int, default=10000,
+                           help='AMIs in the custom population')
+    runParser.add_argument('--years', type=int, default=3,
+                           help='Years of snapshot history in the custom population')
+    runParser.add_argument('--throttle-rate', dest='throttleRate', type=float, default=0.01,
+                           help='Fraction of DeleteSnapshot attempts answered with RequestLimitExceeded')
+    runParser.add_argument('--latency-ms', dest='latencyMs', type=float, default=0,
+                           help='Simulated latency of every API call')
+    runParser.add_argument('--policy', default='7:5:12',
+                           help='Retention policy of the custom population')
+    runParser.add_argument('--concurrency', type=int, default=4,
+                           help='Parallel deletes for the custom population')
+    runParser.add_argument('--stream', action='store_true',
+                           help='Stream deletes while listing in the custom population')
+    runParser.add_argument('--list-concurrency', dest='listConcurrency', type=int, default=0,
+                           help='Partitions listed in parallel for the custom population')
+    runParser.set_defaults(func=runScenarios)
+
+    args = parser.parse_args()
+    args.func(args)